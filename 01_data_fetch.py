@@ -2,81 +2,120 @@
 import os
 import numpy as np
 import pandas as pd
+from datetime import datetime, timedelta
 from tushare_fetcher import TushareFetcher
-import yaml
+from manifest import Manifest
+from storage import Store
+from universe import Universe
+from instrument import RunReport
+from schema import date_array
+from config import load_config
 from tqdm import tqdm
 
-cfg_path = './configs/config.yml'
-
-with open(cfg_path, 'r') as file:
-    configs = yaml.safe_load(file)
+configs = load_config()
 
 token = configs['token']
+report = RunReport.from_config('01_data_fetch')
+# 'stock': one ranged request per stock and endpoint
+# 'date': one whole-market request per trading day
+fetch_mode = configs.get('fetch_mode', 'stock')
+# update: fetch only what is newer than the store holds, up to today, and pick up new constituents
+update = configs.get('update', False)
 
-tushare_fetcher = TushareFetcher(token)
+# responses are cached under cache_dir, offline: true replays them without network
+tushare_fetcher = TushareFetcher(token, limit_per_min=configs.get('limit_per_min', 200), cache_dir=configs.get('cache_dir', './cache'), offline=configs.get('offline', False))
 
-years = np.arange(2000, 2025)
-start_date = '%d1231' % years[0]
+# calendar years fetched, update runs fetch up to today instead of end_year
+years = np.arange(configs.get('start_year', 2000), configs.get('end_year', 2024) + 1)
+start_date = '%d0101' % years[0]
 end_date = '%d1231' % years[-1]
 
 out_dir = './data/'
-if not os.path.exists(out_dir):
-    os.makedirs(out_dir)
+store = Store(out_dir)
+
+
+manifest = Manifest(os.path.join(out_dir, 'manifest.json'))
+
+
+def next_day(date):
+    return (datetime.strptime(str(date), '%Y%m%d') + timedelta(days=1)).strftime('%Y%m%d')
 
 
+report.lap('shibor')
 df_int = pd.DataFrame()
+last_shibor = store.read('shibor', columns=['date'])['date'].max() if store.exists('shibor') else None
 
-for year in years:
-    start_dxate = '%d0101' % year
-    end_date = '%d1231' % year
-    df_year = tushare_fetcher.pro.shibor(start_date=start_date, end_date=end_date)
-    df_int = pd.concat([df_int, df_year], axis=0)
-df_int = df_int.sort_values(by='date', ascending=True)
+if update and last_shibor is not None:
+    df_int = tushare_fetcher.get_shibor(next_day(last_shibor), datetime.now().strftime('%Y%m%d'))
+else:
+    for year in years:
+        df_year = tushare_fetcher.get_shibor('%d0101' % year, '%d1231' % year)
+        df_int = pd.concat([df_int, df_year], axis=0)
 df_int['date'] = df_int['date'].astype(str)
-df_int = df_int.drop_duplicates(subset=['date'], keep='last')
-df_int.to_csv(os.path.join(out_dir, 'shibor.csv'), index=False)
+store.write('shibor', df_int, date_col='date', key=['date'], keep='last')
+
+if update:
+    end_date = datetime.now().strftime('%Y%m%d')
 
 
-path_stock_basic = os.path.join(out_dir, 'stock_basic.csv')
-if os.path.exists(path_stock_basic):
-    stock_basic = pd.read_csv(path_stock_basic)
+report.lap('universe')
+if store.exists('stock_basic') and not update:
+    stock_basic = store.read('stock_basic')
 else:
-    stock_basic = tushare_fetcher.get_stock_basic()
-    stock_basic.to_csv(path_stock_basic, index=False)
+    # delisted and paused names too, a historical universe holds them
+    stock_basic = pd.concat([tushare_fetcher.get_stock_basic(list_status) for list_status in ['L', 'D', 'P']], axis=0, ignore_index=True)
+    store.write('stock_basic', stock_basic)
 
-path_trade_cal = os.path.join(out_dir, 'trade_cal.csv')
-if os.path.exists(path_trade_cal):
-    trade_cal = pd.read_csv(path_trade_cal)
-    trade_cal['cal_date'] = trade_cal['cal_date'].astype(str)
+if store.exists('trade_cal') and not update:
+    trade_cal = store.read('trade_cal')
 else:
     trade_cal = tushare_fetcher.get_trade_calendar(start_date, end_date)
+    trade_cal['cal_date'] = trade_cal['cal_date'].astype(str)
     trade_cal = trade_cal.sort_values(by='cal_date', ascending=True)
-    trade_cal.to_csv(path_trade_cal, index=False)
+    store.write('trade_cal', trade_cal)
 
-last_date = trade_cal.iloc[-1]['cal_date']
+last_date = str(trade_cal.iloc[-1]['cal_date'])
 
-con_path = os.path.join(out_dir, 'index_con.csv')
-if os.path.exists(con_path):
-    index_con = pd.read_csv(con_path)
+# point-in-time universe: the monthly constituent snapshots of the configured indices,
+# or 'all' for every listed stock at every month end, delisted names included
+universe_indices = configs.get('universe', ['399300.SZ'])
+if universe_indices == 'all':
+    open_days = trade_cal[trade_cal['is_open'] == 1]['cal_date'] if 'is_open' in trade_cal else trade_cal['cal_date']
+    open_days = open_days.astype(str)
+    month_ends = open_days.groupby(open_days.str[:6]).max().values
+    membership = Universe.from_listings(stock_basic, month_ends)
 else:
-    index_con = tushare_fetcher.pro.index_weight(index_code='399300.SZ', trade_date=last_date)
-    index_con.to_csv(con_path, index=False)
+    snapshots = store.read('index_weight') if store.exists('index_weight') else pd.DataFrame(columns=['index_code', 'con_code', 'trade_date', 'weight'])
+    frames = []
+    for index_code in universe_indices:
+        held_dates = snapshots[snapshots['index_code'] == index_code]['trade_date']
+        if len(held_dates) > 0 and not update:
+            continue
+        first_year = int(held_dates.max()) // 10000 if len(held_dates) > 0 else years[0]
+        for year in range(first_year, int(end_date[:4]) + 1):
+            frames.append(tushare_fetcher.get_index_weights(index_code, '%d0101' % year, '%d1231' % year))
+    if frames:
+        df = pd.concat(frames, axis=0, ignore_index=True)
+        df['trade_date'] = df['trade_date'].astype(str)
+        store.write('index_weight', df, date_col='trade_date', key=['index_code', 'con_code', 'trade_date'])
+        snapshots = store.read('index_weight')
+    membership = Universe.from_snapshots(snapshots[snapshots['index_code'].isin(universe_indices)])
+membership.save(os.path.join(out_dir, 'membership.npz'))
 
-code_list = index_con['con_code'].values
+code_list = membership.all_codes()
 
-path_latest_basic = os.path.join(out_dir, 'latest_basic.csv')
-if os.path.exists(path_latest_basic):
-    latest_basic = pd.read_csv(path_latest_basic)
+if store.exists('latest_basic') and not update:
+    latest_basic = store.read('latest_basic')
 else:
     latest_basic = tushare_fetcher.get_daily_basic_one(last_date)
-    latest_basic.to_csv(path_latest_basic, index=False)
+    store.write('latest_basic', latest_basic)
 latest_basic = latest_basic.sort_values(by='total_mv', ascending=False)
 
 
 # filter banks and ensurance
 bank_industry = ['银行', '保险']
 stock_selected = stock_basic[~stock_basic['industry'].isin(bank_industry)]
-stock_selected = stock_selected[stock_selected['ts_code'].isin(code_list)]
+stock_selected = stock_selected[stock_selected['ts_code'].isin(code_list)].drop_duplicates(subset='ts_code')
 
 codes = stock_selected['ts_code']
 print(len(codes))
@@ -84,58 +123,174 @@ print(len(codes))
 universe = []
 # codes = latest_basic['ts_code'].values[:10]
 
+names = dict(zip(stock_basic['ts_code'], stock_basic['name']))
 for code in codes:
-    name = stock_basic[stock_basic['ts_code'] == code]['name'].values[0]
-    universe.append({'code': code, 'name': name})
+    universe.append({'code': code, 'name': names[code]})
 # print(universe)
 universe_df = pd.DataFrame(universe)
-universe_df.to_csv(os.path.join(out_dir, 'universe.csv'), index=False)
+store.write('universe', universe_df)
 
-for stock in tqdm(universe, dynamic_ncols=True):
-    path_stock = os.path.join(out_dir, f"{stock['code']}.csv")
-    if os.path.exists(path_stock):
-        stock_df = pd.read_csv(path_stock)
-    else:
-        stock_df = tushare_fetcher.get_daily_data(stock['code'], start_date, end_date)
-        stock_df = stock_df.sort_values(by='trade_date', ascending=True)
-        stock_df.to_csv(path_stock, index=False)
+# where each endpoint lands in the store and the date its manifest entry tracks
+datasets = {
+    'daily': {'dataset': 'daily', 'date_col': 'trade_date', 'key': ['ts_code', 'trade_date'], 'keep': 'last', 'last_col': 'trade_date'},
+    'basic': {'dataset': 'basic', 'date_col': 'trade_date', 'key': ['ts_code', 'trade_date'], 'keep': 'last', 'last_col': 'trade_date'},
+    'index': {'dataset': 'index', 'date_col': 'trade_date', 'key': ['ts_code', 'trade_date'], 'keep': 'last', 'last_col': 'trade_date'},
+    # restated reports share the end_date of the original one, only the first announced row is kept
+    'fina': {'dataset': 'financial', 'date_col': 'end_date', 'key': ['ts_code', 'end_date'], 'keep': 'first', 'last_col': 'ann_date',
+             'sort_by': ['ts_code', 'end_date', 'ann_date']},
+    # the restatements themselves, every later announcement of a period
+    'restated': {'dataset': 'financial_restated', 'date_col': 'end_date', 'key': ['ts_code', 'end_date', 'ann_date'], 'keep': 'last',
+                 'last_col': 'ann_date'},
+}
+
+# the manifest answers without touching the store, codes it does not know are looked up once per endpoint
+held = {}
+def held_last(endpoint, code, col=None):
+    last = manifest.get(endpoint, code) if col is None else None
+    if last is None:
+        spec = datasets[endpoint]
+        col = col or spec['last_col']
+        if (endpoint, col) not in held:
+            held[(endpoint, col)] = store.last_dates(spec['dataset'], 'ts_code', col)
+        last = held[(endpoint, col)].get(code)
+        # the store holds int dates, the manifest and the fetch parameters 'YYYYMMDD' strings
+        last = None if last is None else str(last)
+    return last
+
+
+# delisting day of every delisted code, 0 for listed ones
+delist_dates = dict(zip(stock_basic['ts_code'], date_array(stock_basic['delist_date']))) if 'delist_date' in stock_basic else {}
+
+
+# first date to fetch for every code and endpoint, codes that are up to date are left out.
+# stocks the store does not hold yet (new constituents included) get their whole history
+def tail_start(endpoint, code):
+    last = held_last(endpoint, code)
+    if last is None:
+        return start_date
+    if not update or next_day(last) > last_date:
+        return None
+    # a code delisted by the day the store was fetched up to has no new rows
+    if 0 < delist_dates.get(code, 0) <= int(next_day(held_through(endpoint))):
+        return None
+    return next_day(last)
+
+
+# the last day any code of an endpoint is held up to, every held code was asked for rows until then
+through = {}
+def held_through(endpoint):
+    if endpoint not in through:
+        through[endpoint] = max(int(last) for last in [held_last(endpoint, code) for code in codes] + ['0'] if last is not None)
+    return str(through[endpoint])
+
+
+def next_period_end(end):
+    """The semiannual or annual period end after a held one"""
+    return end[:4] + '1231' if end[4:] == '0630' else '%d0630' % (int(end[:4]) + 1)
+
+
+report.lap('plan')
+daily_start = {}
+basic_start = {}
+fina_start = {}
+for stock in universe:
+    code = stock['code']
+    daily_start[code] = tail_start('daily', code)
+    basic_start[code] = tail_start('basic', code)
+    # announcements of the last period land in the following year, restatements re-announce old periods.
+    # an update only asks once the next period has ended, for a code still listed at its end
+    last_ann = held_last('fina', code)
+    if last_ann is None:
+        fina_start[code] = '%d0101' % years[0]
+    elif update:
+        held_end = held_last('fina', code, col='end_date')
+        period = next_period_end(held_end) if held_end is not None else None
+        if period is None or (period <= end_date and not 0 < delist_dates.get(code, 0) <= int(period)):
+            fina_start[code] = last_ann
+daily_start = {code: start for code, start in daily_start.items() if start is not None}
+basic_start = {code: start for code, start in basic_start.items() if start is not None}
+
+# queue the fetch jobs and let the fetcher's worker pool drain them
+jobs = {}
+if fetch_mode == 'date':
+    # calls scale with the number of trading days instead of stocks
+    for trade_date in trade_cal['cal_date'].astype(str):
+        if daily_start and trade_date >= min(daily_start.values()):
+            jobs[(trade_date, 'daily_date')] = ('get_daily_data_one', {'trade_date': trade_date})
+        if basic_start and trade_date >= min(basic_start.values()):
+            jobs[(trade_date, 'basic_date')] = ('get_daily_basic_one', {'trade_date': trade_date})
+else:
+    for code, start in daily_start.items():
+        jobs[(code, 'daily')] = ('get_daily_data', {'ts_code': code, 'start_date': start, 'end_date': end_date})
+    for code, start in basic_start.items():
+        jobs[(code, 'basic')] = ('get_daily_basic', {'ts_code': code, 'start_date': start, 'end_date': end_date})
+
+# one ranged request per stock
+for code, start in fina_start.items():
+    jobs[(code, 'fina')] = ('get_fina_indicator', {'ts_code': code, 'start_date': start, 'end_date': '%d1231' % (int(end_date[:4]) + 1)})
 
-    path_basic = os.path.join(out_dir, f"{stock['code']}_basic.csv")
-    if os.path.exists(path_basic):
-        basic_df = pd.read_csv(path_basic)
-    else:
-        basic_df = tushare_fetcher.get_daily_basic(stock['code'], start_date, end_date)
-        basic_df = basic_df.sort_values(by='trade_date', ascending=True)
-        basic_df.to_csv(path_basic, index=False)
-    
-    path_financial = os.path.join(out_dir, f"{stock['code']}_financial.csv")
-
-    if os.path.exists(path_financial):
-        financial_df = pd.read_csv(path_financial)
-    else:
-        financial_dict = []
-        for year in years:
-            periods = ['%d0630' % year, '%d1231' % year]
-            # periods = ['%d1231' % year]
-            for period in periods:
-                financial_year_df = tushare_fetcher.get_fina_indicator_one(stock['code'], period)
-                if len(financial_year_df) == 0:
-                    continue
-                financial_year_df = financial_year_df.sort_values(by='end_date', ascending=True)
-                financial_year_df = financial_year_df.head(1)
-                year_dict = financial_year_df.to_dict(orient='records')
-                financial_dict.append(year_dict[0])
-
-        financial_df = pd.DataFrame(financial_dict)
-        financial_df.to_csv(path_financial, index=False)
-
-    
 for code in tushare_fetcher.index_list:
-    path_index = os.path.join(out_dir, f"index_{code}.csv")
-    if os.path.exists(path_index):
-        index_df = pd.read_csv(path_index)
+    start = tail_start('index', code)
+    if start is not None:
+        jobs[(code, 'index')] = ('get_index_data', {'ts_code': code, 'start_date': start, 'end_date': end_date})
+
+
+# results are buffered and merged into the store in batches, rewriting the year partitions once per batch
+flush_rows = configs.get('flush_rows', 2000000)
+pending = {endpoint: [] for endpoint in datasets}
+
+def flush(endpoint):
+    if len(pending[endpoint]) == 0:
+        return
+    spec = datasets[endpoint]
+    df = pd.concat(pending[endpoint], axis=0, ignore_index=True)
+    pending[endpoint] = []
+    with report.section('store_write'):
+        store.write(spec['dataset'], df, date_col=spec['date_col'], key=spec['key'],
+                    sort_by=spec.get('sort_by'), keep=spec['keep'])
+    report.rows(spec['dataset'], len(df))
+    for code, last in df.dropna(subset=[spec['last_col']]).groupby('ts_code')[spec['last_col']].max().items():
+        manifest.set(endpoint, code, max(last, manifest.get(endpoint, code) or last))
+    manifest.save()
+
+
+def save(endpoint, df):
+    if len(df) == 0:
+        return
+    pending[endpoint].append(df)
+    if sum(len(df) for df in pending[endpoint]) >= flush_rows:
+        flush(endpoint)
+
+
+report.lap('fetch')
+report.rows('jobs', len(jobs))
+# the first day every code needs in date mode, as ints to compare a whole day's codes at once
+date_starts = {'daily_date': ('daily', pd.Series({code: int(start) for code, start in daily_start.items()}, dtype='float64')),
+               'basic_date': ('basic', pd.Series({code: int(start) for code, start in basic_start.items()}, dtype='float64'))}
+for key, df in tqdm(tushare_fetcher.fetch_many(jobs), total=len(jobs), dynamic_ncols=True):
+    code, kind = key[0], key[1]
+    if kind in ['daily', 'basic', 'index']:
+        save(kind, df)
+    elif kind in date_starts:
+        # only keep the codes that need the day, the whole market is several times larger
+        endpoint, starts = date_starts[kind]
+        save(endpoint, df[df['ts_code'].map(starts).le(int(key[0])).values])
     else:
-        index_df = tushare_fetcher.get_index_data(code, start_date, end_date)
-        index_df = index_df.sort_values(by='trade_date', ascending=True)
-        index_df.to_csv(path_index, index=False)
+        # keep the semiannual and annual reports in range
+        financial_df = df[df['end_date'].str[4:].isin(['0630', '1231'])]
+        financial_df = financial_df[(financial_df['end_date'] >= '%d0101' % years[0]) & (financial_df['end_date'] <= end_date)]
+
+        # a later announcement of a period in the response, or of a period the store already holds
+        restated = financial_df['ann_date'] > financial_df.groupby('end_date')['ann_date'].transform('min')
+        held_end = held_last('fina', code, col='end_date') if update else None
+        if held_end is not None:
+            restated |= (financial_df['end_date'] <= held_end) & (financial_df['ann_date'] > fina_start[code])
+        save('restated', financial_df[restated])
+        save('fina', financial_df)
+
+report.lap('flush')
+for endpoint in datasets:
+    flush(endpoint)
 
+report.add('fetcher', tushare_fetcher.stats())
+report.finish()
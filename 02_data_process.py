@@ -1,226 +1,163 @@
-import pandas as pd
 import os
-import numpy as np
-from glob import glob
-from tqdm import tqdm
-from datetime import datetime
-from dateutil.relativedelta import relativedelta
-
+import pandas as pd
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from storage import Store
+from manifest import Manifest, State
+from fingerprints import code_fingerprint, fingerprint
+from universe import Universe
+from instrument import RunReport
+from rolling import shift_months
+from monthly import complete_months, shibor_month, market_month, process_codes, write_months
+from config import load_config
+
+data_root = './data'
+membership_path = os.path.join(data_root, 'membership.npz')
 out_month= 'data_month'
-if not os.path.exists(out_month):
-    os.makedirs(out_month)
-
-universe_path = './data/universe.csv'
-universe = pd.read_csv(universe_path).to_dict(orient='records')
-# print(universe)
-
-date_path = './data/trade_cal.csv'
-trade_cal = pd.read_csv(date_path)
-trade_cal['cal_date'] = pd.to_datetime(trade_cal['cal_date'], format='%Y%m%d')
-dates = trade_cal['cal_date'].dt.strftime('%Y%m%d').tolist()
-print(len(dates))
-
-years = np.arange(2000, 2025)
-months = np.arange(1, 13)
-
-
-shibor_path = os.path.join('./data', 'shibor.csv')
-shibor_df = pd.read_csv(shibor_path)
-shibor_df['date'] = shibor_df['date'].astype(str)
-
-shibor_dict = []
-for year in years:
-    for month in months:
-        start_m = '%d%02d01' % (year, month)
-        end_m = '%d%02d31' % (year, month)
-        month_df = shibor_df[(shibor_df['date'] >= start_m) & (shibor_df['date'] <= end_m)]
-        if not month_df.empty:
-            shibor_month = np.mean(month_df['1y'].values[0]) / 100
+per_code_root = os.path.join(out_month, 'per_code')
+# the last month written, where an update carries on from
+state_path = os.path.join(out_month, 'state.json')
+
+# trailing windows in months as (lookback, skip), 12-1 momentum would be (12, 1)
+windows = {'vol': (6, 0), 'momentum': (6, 0)}
+market_months = 6
+# financial reports join each month as of their announcement, semiannual ones with ('0630', '1231'),
+# lag_months: n uses end_date + n months instead of ann_date
+fin_options = {'periods': ('1231',), 'lag_months': None}
+
+
+OUTPUTS = ['stock_month', 'basic_month', 'fin_month']
+
+
+def save_codes(per_code_root, code_manifest, chunks, results, prints):
+    """Replace the files of every stock of the chunks with its new rows and record its fingerprint"""
+    stores = {output: Store(os.path.join(per_code_root, output)) for output in OUTPUTS}
+    for chunk, parts in zip(chunks, results):
+        for output, df in zip(OUTPUTS, parts):
+            for code in chunk:
+                stores[output].remove(code)
+            for code, df_code in df.groupby('code', sort=False, observed=True):
+                stores[output].write(code, df_code)
+        for code in chunk:
+            code_manifest.set('stock', code, prints[code])
+        code_manifest.save()
+
+
+def main():
+    configs = load_config()
+    # stocks are split into chunks spread over a process pool, workers: 1 runs them in this process
+    workers = configs.get('workers', os.cpu_count())
+    chunk_size = configs.get('chunk_size', 100)
+    # update: only the months after the last one written are computed and appended
+    update = configs.get('update', False)
+    report = RunReport.from_config('02_data_process')
+
+    report.lap('market')
+    store = Store(data_root)
+    store_month = Store(out_month)
+    raw_manifest = Manifest(os.path.join(data_root, 'manifest.json'))
+    state = State(state_path)
+
+    universe = store.read('universe').to_dict(orient='records')
+    # print(universe)
+
+    # months from start_year on, up to the last one the daily bars cover to its last trading day
+    trade_cal = store.read('trade_cal')
+    held = [int(last) for last in raw_manifest.entries.get('daily', {}).values()]
+    months = complete_months(trade_cal, max(held) if held else trade_cal['cal_date'].max(), configs.get('start_year', 2000))
+    last_month = state.get('monthly', 'last_month')
+    first = None
+    if update and last_month is not None and store_month.exists('combined_all'):
+        months = [month for month in months if month > int(last_month)]
+        if not months:
+            print(f'no month after {last_month} to add')
+            report.finish()
+            return
+        first = months[0]
+    print(len(trade_cal), f'{len(months)} months from {months[0]}' if months else 'no months')
+
+    shibor_df = store.read('shibor', date_col='date', start=first)
+    shibor_df_month = shibor_month(shibor_df, months)
+    shibor_df_month = shibor_df_month.sort_values(by='date', ascending=True).dropna()
+    write_months(store_month, 'shibor_month', shibor_df_month, first)
+
+    index_start = None if first is None else int(shift_months([first], market_months)[0])
+    index_df = store.read('index', codes=['000001.SH'], date_col='trade_date', start=index_start)
+    market_df = market_month(index_df, months, market_months)
+    market_df = market_df.sort_values(by='date', ascending=True).dropna()
+    write_months(store_month, 'market_month', market_df, first)
+
+    # every stock of the universe with financial data, names stay in the universe table
+    fin_codes = set(store.read('financial', columns=['ts_code'], codes=[stock['code'] for stock in universe])['ts_code'])
+    codes = [stock['code'] for stock in universe if stock['code'] in fin_codes]
+    report.rows('stocks', len(codes))
+
+    if first is None:
+        report.lap('fingerprint')
+        # a stock is rebuilt only when its fingerprint changed: what the fetch manifest holds for it,
+        # the monthly code and the parameters. the others are read back from their per-stock files
+        store_codes = Store(per_code_root)
+        code_manifest = State(os.path.join(per_code_root, 'fingerprints.json'))
+        params = fingerprint(months, windows, fin_options, code_fingerprint('monthly.py'))
+        prints = {code: fingerprint(params, [raw_manifest.get(endpoint, code) for endpoint in ['daily', 'basic', 'fina']]) for code in codes}
+        stale = [code for code in codes if code_manifest.get('stock', code) != prints[code]]
+        print(f'{len(stale)} of {len(codes)} stocks to rebuild')
+        report.rows('stocks_rebuilt', len(stale))
+    else:
+        # the new months of every stock, from the window of daily rows before them
+        stale = codes
+
+    report.lap('stocks')
+    chunks = [stale[i:i + chunk_size] for i in range(0, len(stale), chunk_size)]
+    run_chunk = partial(process_codes, data_root, months=months, windows=windows, fin_options=fin_options, start=first)
+
+    def collect(results):
+        # a full run saves every chunk to the per-stock files as it comes, an update keeps the few new rows
+        if first is None:
+            save_codes(per_code_root, code_manifest, chunks, results, prints)
+            return []
+        return list(results)
+
+    if workers > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(chunks))) as pool:
+            results = collect(pool.map(run_chunk, chunks))
+    else:
+        results = collect(map(run_chunk, chunks))
+
+    report.lap('combine')
+    # every stock's rows are read at once, then sorted by universe order and date
+    order = pd.Index(codes)
+    frames = []
+    for i, output in enumerate(OUTPUTS):
+        if first is None:
+            df = store_codes.read(output, codes=codes, code_col='code')
         else:
-            shibor_month = 3.5 / 100
-
-        shibor_dict.append({
-            'date': '%d%02d01' % (year, month),
-            'shibor': shibor_month,
-        })
-shibor_df_month = pd.DataFrame(shibor_dict)
-shibor_df_month = shibor_df_month.sort_values(by='date', ascending=True).dropna()
-shibor_df_month.to_csv(os.path.join(out_month, 'shibor_month.csv'), index=False, float_format='%.4f')
-
-
-fin_paths = glob(os.path.join('./data', '*_financial.csv'))
-fin_codes = []
-for fin_path in fin_paths:
-    code = os.path.basename(fin_path).split('_')[0]
-    fin_codes.append(code)
-
-
-index_df = pd.read_csv(os.path.join('./data', 'index_000001.SH.csv'))
-index_df['trade_date'] = index_df['trade_date'].astype(str)
-
-market_dict = []
-for year in years:
-    for month in months:
-        start_m = '%d%02d01' % (year, month)
-        end_m = '%d%02d31' % (year, month)
-        month_df = index_df[(index_df['trade_date'] >= start_m) & (index_df['trade_date'] <= end_m)]
-        month_df = month_df.dropna(subset=['pct_chg'])
-
-        if not month_df.empty:
-            return_month = (np.exp(np.sum(np.log(1 + month_df['pct_chg'] / 100))) - 1)
-        else:
-            return_month = np.nan
-
-        end_m = '%d%02d01' % (year, month)
-        current_date = datetime.strptime(end_m, '%Y%m%d')
-        period_start = current_date - relativedelta(months=6)
-        period_start = period_start.strftime('%Y%m%d')
-
-        ref_index = index_df[(index_df['trade_date'] >= period_start) & (index_df['trade_date'] < end_m)]
-        if not ref_index.empty:
-            ref_index = ref_index.dropna(subset=['pct_chg'])
-            market_return_ann = (np.exp(np.mean(np.log(1 + ref_index['pct_chg'] / 100)) * 220) - 1)
-        else:
-            market_return_ann = np.nan
-
-        market_dict.append({
-            'date': '%d%02d01' % (year, month),
-            'market_return_ann': market_return_ann,
-            'market_return_month': return_month,
-        })
-market_df = pd.DataFrame(market_dict)
-market_df = market_df.sort_values(by='date', ascending=True).dropna()
-market_df.to_csv(os.path.join(out_month, 'market_month.csv'), index=False, float_format='%.4f')
-        
-
-
-df_combined_all = pd.DataFrame()
-for stock in tqdm(universe, dynamic_ncols=True):
-    if stock['code'] not in fin_codes:
-        continue
-
-    stock['code']
-
-    stock_path = os.path.join('./data', f"{stock['code']}.csv")
-    stock_df = pd.read_csv(stock_path)
-    stock_df['trade_date'] = stock_df['trade_date'].astype(str)
-
-    basic_path = os.path.join('./data', f"{stock['code']}_basic.csv")
-    basic_df = pd.read_csv(basic_path)
-    basic_df['trade_date'] = basic_df['trade_date'].astype(str)
-
-    financial_df = pd.read_csv(os.path.join('./data', f"{stock['code']}_financial.csv"))
-    financial_df['end_date'] = financial_df['end_date'].astype(str)
-
-    month_dict = []
-    basic_dict = []
-    fin_dict = []
-    for year in years:
-        for month in months:
-            start_m = '%d%02d01' % (year, month)
-            end_m = '%d%02d31' % (year, month)
-
-            month_df = stock_df[(stock_df['trade_date'] >= start_m) & (stock_df['trade_date'] <= end_m)]
-            month_df = month_df.dropna(subset=['pct_chg'])
-            if not month_df.empty:
-                
-                # Example date
-                current_date = datetime.strptime(start_m, '%Y%m%d')
-                period_start = current_date - relativedelta(months=6)
-                period_start = period_start.strftime('%Y%m%d')
-
-                period_end = start_m
-
-                ref_data = stock_df[(stock_df['trade_date'] >= period_start) & (stock_df['trade_date'] < period_end)]
-
-                if not ref_data.empty:
-                    ref_data = ref_data.dropna(subset=['pct_chg'])
-                    vol = (ref_data['pct_chg'] / 100).std() / len(ref_data) * 220
-                    momentum = (np.exp(np.mean(np.log(1 + ref_data['pct_chg'] / 100)) * 220) - 1)
-                else:
-                    vol = np.nan
-                    momentum = np.nan
-
-                open = month_df['open'].values[0]
-                close = month_df['close'].values[-1]
-
-                return_month = (np.exp(np.sum(np.log(1 + month_df['pct_chg'] / 100))) - 1)
-                
-                month_dict.append({
-                    'code': stock['code'],
-                    'name': stock['name'],
-                    'date': '%d%02d01' % (year, month),
-                    'open': open,
-                    'close': close,
-                    'return': return_month,
-                    'vol': vol,
-                    'momentum': momentum,
-                })
-
-            basic_month_df = basic_df[(basic_df['trade_date'] >= start_m) & (basic_df['trade_date'] <= end_m)]
-            if not month_df.empty and len(basic_month_df) > 0:
-
-                t_mv = basic_month_df['total_mv'].values[0]
-                t_pb = basic_month_df['pb'].values[0]
-                t_pe = basic_month_df['pe_ttm'].values[0]
-                basic_dict.append({
-                    'code': stock['code'],
-                    'name': stock['name'],
-                    'date': '%d%02d01' % (year, month),
-                    'total_share': basic_month_df['total_share'].values[0],
-                    't_mv': t_mv,
-                    't_pb': t_pb,
-                    't_pe': t_pe,
-                })
-
-
-            # 'roe', 'roa', 'debt_to_assets'
-            # assign financial to month
-            if month > 3:
-                fin_month = '%d1231' % (year)
-            elif month <= 3:
-                fin_month = '%d1231' % (year - 1)
-
-            fin_ref_df = financial_df[financial_df['end_date'] == fin_month]
-            if not fin_ref_df.empty:
-
-                fin_dict.append({
-                    'code': stock['code'],
-                    'name': stock['name'],
-                    'date': '%d%02d01' % (year, month),
-                    'roe': fin_ref_df['roe'].values[0],
-                    'roa': fin_ref_df['roa'].values[0],
-                    'npta': fin_ref_df['npta'].values[0], # 总资产净利润
-                    'assets_yoy': fin_ref_df['assets_yoy'].values[0], # 总资产同比增长率
-                    'bps': fin_ref_df['bps'].values[0], # 每股净资产
-                    'debt_to_assets': fin_ref_df['debt_to_assets'].values[0],
-                })
-        
-            
-    stock_month_df = pd.DataFrame(month_dict)
-    stock_month_df = stock_month_df.sort_values(by='date', ascending=True)
-    stock_month_df.to_csv(os.path.join(out_month, f"{stock['code']}_month.csv"), index=False, float_format='%.4f')
-
-    stock_month_df = stock_month_df.set_index(['code', 'name', 'date'])
-
-    basic_month_df = pd.DataFrame(basic_dict)
-    basic_month_df = basic_month_df.sort_values(by='date', ascending=True)
-    basic_month_df.to_csv(os.path.join(out_month, f"{stock['code']}_basic_month.csv"), index=False, float_format='%.4f')
-    basic_month_df = basic_month_df.set_index(['code', 'name', 'date'])
-
-    fin_month_df = pd.DataFrame(fin_dict)
-    fin_month_df = fin_month_df.sort_values(by='date', ascending=True)
-    fin_month_df.to_csv(os.path.join(out_month, f"{stock['code']}_fin_month.csv"), index=False, float_format='%.4f')
-    fin_month_df = fin_month_df.set_index(['code', 'name', 'date'])
-
-    df_combined = stock_month_df.join(basic_month_df, how='left', rsuffix='_basic')
-    df_combined = df_combined.join(fin_month_df, how='left', rsuffix='_fin')
-    df_combined = df_combined.reset_index()
-    df_combined.to_csv(os.path.join(out_month, f"{stock['code']}_combined.csv"), index=False, float_format='%.4f')
-
-    df_combined_all = pd.concat([df_combined_all, df_combined], axis=0)
-    
-df_combined_all.to_csv(os.path.join(out_month, 'combined_all.csv'), index=False, float_format='%.4f')
-
-    
-
+            df = pd.concat([parts[i] for parts in results], axis=0, ignore_index=True)
+        df = df.assign(order=order.get_indexer(df['code'])).sort_values(by=['order', 'date'], kind='stable')
+        frames.append(df.drop(columns=['order']).reset_index(drop=True))
+    stock_month_df, basic_month_df, fin_month_df = frames
+
+    df_combined_all = stock_month_df.merge(basic_month_df, on=['code', 'date'], how='left')
+    df_combined_all = df_combined_all.merge(fin_month_df, on=['code', 'date'], how='left')
+    # whether the stock was in the universe at the start of the month, all rows without a membership index
+    if os.path.exists(membership_path):
+        membership = Universe.load(membership_path)
+        df_combined_all['member'] = membership.contains(df_combined_all['code'].values, df_combined_all['date'].values)
+    else:
+        df_combined_all['member'] = True
+
+    report.lap('write')
+    report.rows('combined_all', len(df_combined_all))
+    # one dataset per output instead of a file per stock, partitioned by year of the month
+    write_months(store_month, 'stock_month', stock_month_df, first, date_col='date')
+    write_months(store_month, 'basic_month', basic_month_df, first, date_col='date')
+    write_months(store_month, 'fin_month', fin_month_df, first, date_col='date')
+    write_months(store_month, 'combined_all', df_combined_all, first, date_col='date')
+    if months:
+        state.set('monthly', 'last_month', int(months[-1]))
+        state.save()
+    report.finish()
+
+
+if __name__ == '__main__':
+    main()
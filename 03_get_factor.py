@@ -1,25 +1,65 @@
 import pandas as pd
 import os
-import numpy as np
-import copy
-
+import sys
+from storage import Store
+from panel import Panel
+from rolling import shift_months
+from monthly import write_months
+from factor_engine import DEFAULT_FACTORS, factor_returns, broadcast, holding_state, save_state, load_state
+from instrument import RunReport
+from config import load_config
+
+configs = load_config()
+# update: only the months of combined_all after the last one processed are added, the April legs
+# they are held in come from factor_state.npz
+update = configs.get('update', False)
 
 out_dir = 'data_processed'
-if not os.path.exists(out_dir):
-    os.makedirs(out_dir)
-
-factor_path = 'data_processed/stock_factors.csv'
-
-market_path = 'data_month/market_month.csv'
-stock_path = 'data_month/combined_all.csv'
-
-df_market = pd.read_csv(market_path)
-df_stocks = pd.read_csv(stock_path)
-
-df_rf = pd.read_csv('data_month/shibor_month.csv')
+state_path = os.path.join(out_dir, 'factor_state.npz')
+store_month = Store('data_month')
+store_data = Store('data')
+store_processed = Store(out_dir)
+report = RunReport.from_config('03_get_factor')
+
+
+def with_names(df):
+    out = df.copy()
+    out.insert(1, 'name', names.reindex(out['code'].astype(str)).values)
+    return out
+
+
+def to_csv(df, name, float_format):
+    """Write a csv export, or add the new months' rows to it on an update"""
+    path = os.path.join(out_dir, name)
+    appending = first is not None and os.path.exists(path)
+    with_names(df).to_csv(path, index=False, float_format=float_format, mode='a' if appending else 'w', header=not appending)
+
+
+report.lap('read')
+
+df_market = store_month.read('market_month')
+state, first = None, None
+if update and os.path.exists(state_path) and store_processed.exists('stock_factors_processed'):
+    state, last_month = load_state(state_path)
+    first = int(shift_months([last_month], -1)[0])
+df_stocks = store_month.read('combined_all', date_col='date', start=first)
+if first is not None and df_stocks.empty:
+    print(f'no month after {last_month} to add')
+    report.finish()
+    sys.exit(0)
+last_month = int(df_stocks['date'].max())
+# point-in-time universe: only months the stock was a member
+if 'member' in df_stocks:
+    df_stocks = df_stocks[df_stocks['member'].astype(bool)].drop(columns=['member'])
+
+df_rf = store_month.read('shibor_month')
+# code -> name, the stored rows only carry the codes
+names = store_data.read('universe').astype({'code': str}).set_index('code')['name']
 
 stocks = df_stocks['code'].unique()
 
+report.rows('combined_all', len(df_stocks))
+report.lap('factors')
 # factors:
 # market, size, value, profitability, investment, momentum
 df_stocks['size'] = df_stocks['t_mv'] / 1e8
@@ -28,7 +68,7 @@ df_stocks['profitability'] = df_stocks['npta'] / 100 # net profit to total asset
 df_stocks['investment'] = df_stocks['assets_yoy'] / 100 # total assets growth
 
 
-df_factors = df_stocks[['code', 'name', 'date', 'return', 'size', 'value', 'profitability', 'investment', 'momentum']]
+df_factors = df_stocks[['code', 'date', 'return', 'size', 'value', 'profitability', 'investment', 'momentum']]
 
 df_factors = pd.merge(df_factors, df_market[['date', 'market_return_month']], on='date', how='left')
 df_factors.rename(columns={'market_return_month': 'market'}, inplace=True)
@@ -38,86 +78,27 @@ df_factors.rename(columns={'shibor': 'rf'}, inplace=True)
 
 
 df_factors = df_factors.dropna()
-df_factors.to_csv('data_processed/stock_factors.csv', index=False, float_format='%.4f')
-
-
-df_factors = pd.read_csv(factor_path)
-df_factors['date'] = df_factors['date'].astype(str)
-
-
-def update_portfolio(portfolio_year, data):
-
-    cols = portfolio_year.keys()
-
-    for col in cols:
-        ratio = portfolio_year[col]['ratio']
-        assending = portfolio_year[col]['assending']
-        df_rank = data.sort_values(by=col, ascending=assending)
-
-        df_top = df_rank.head(int(len(df_rank) * ratio))
-        df_bottom = df_rank.tail(int(len(df_rank) * ratio))
-
-        portfolio_year[col]['top'] += df_top['code'].values.tolist()
-        portfolio_year[col]['bot'] += df_bottom['code'].values.tolist()
-
-    return
+report.lap('write')
+write_months(store_processed, 'stock_factors', df_factors, first, date_col='date')
+# csv exports are what the R scripts read, with the names joined back on, in date order so an update appends
+to_csv(df_factors.sort_values(by='date', kind='stable'), 'stock_factors.csv', '%.4f')
 
-def update_factors(portfolio_year, data):
-
-    factor_dict = {
-        'size': 'SMB',
-        'value': 'HML',
-        'profitability': 'RMW',
-        'investment': 'CMA',
-        'momentum': 'UMD'
-    }
-    cols = portfolio_year.keys()
-
-    data_new = data[['code', 'name', 'date', 'return', 'market', 'rf']].copy()
-    for col in cols:
-        top_codes = portfolio_year[col]['top']
-        bot_codes = portfolio_year[col]['bot']
-        df_top = data[data['code'].isin(top_codes)]
-        df_bottom = data[data['code'].isin(bot_codes)]
-        factor = df_top['return'].mean() - df_bottom['return'].mean()
-        data_new[factor_dict[col]] = [factor] * len(data_new)
-
-    return data_new
 
+report.lap('portfolio')
 # get portfolio factor
-
-years = np.arange(2000, 2025)
-months = np.arange(1, 13)
-
-portfolio_tmp = {'size': {'top': [], 'bot': [], 'ratio': 0.5, 'assending': True}, 
-              'value': {'top': [], 'bot': [], 'ratio': 0.3, 'assending': False}, 
-              'profitability': {'top': [], 'bot': [], 'ratio': 0.3, 'assending': False}, 
-              'investment': {'top': [], 'bot': [], 'ratio': 0.3, 'assending': False}, 
-              'momentum': {'top': [], 'bot': [], 'ratio': 0.3, 'assending': False}
-            }
-
-portfolios = {}
-
-df_factor_processed = pd.DataFrame()
-for year in years:
-    for month in months:
-        if year == 2000 or (year == 2001 and month < 4):
-            continue
-        date = '%d%02d01' % (year, month)
-        df_sel = df_factors[df_factors['date'] == date]
-        if month == 4:
-            portfolios[year] = copy.deepcopy(portfolio_tmp)
-            update_portfolio(portfolios[year], df_sel)
-
-            # print('top', len(portfolios[year]['size']['top']))
-            # print('bot', len(portfolios[year]['size']['bot']))
-
-            portfolios['latest'] = copy.deepcopy(portfolios[year])
-
-        df_cal = update_factors(portfolios['latest'], df_sel)
-        df_factor_processed = pd.concat([df_factor_processed, df_cal], axis=0, ignore_index=True)
-
-
-
-
-df_factor_processed.to_csv('data_processed/stock_factors_processed.csv', index=False, float_format='%.6f')
\ No newline at end of file
+# portfolios are formed every April from 2001 on and held for twelve months
+panel = Panel.from_frame(df_factors, fields=['return', 'size', 'value', 'profitability', 'investment', 'momentum'])
+df_factor_month = factor_returns(panel, DEFAULT_FACTORS, months=(4,), start=20010401, state=state)
+state = holding_state(panel, DEFAULT_FACTORS, months=(4,), start=20010401, state=state)
+df_factor_processed = broadcast(df_factors, df_factor_month)
+
+# with the market return and rf of every month, the factor table of the regressions
+df_factor_month = df_factor_month.merge(df_factors[['date', 'market', 'rf']].drop_duplicates(subset='date'), on='date', how='left')
+report.lap('write')
+write_months(store_processed, 'factor_returns', df_factor_month, first)
+write_months(store_processed, 'stock_factors_processed', df_factor_processed, first, date_col='date')
+to_csv(df_factor_processed, 'stock_factors_processed.csv', '%.6f')
+save_state(state_path, state, last_month)
+report.rows('stock_factors', len(df_factors))
+report.rows('stock_factors_processed', len(df_factor_processed))
+report.finish()
@@ -0,0 +1,56 @@
+import os
+import numpy as np
+from storage import Store
+from universe import Universe
+from daily import DailyFactorStream
+from instrument import RunReport
+from config import load_config
+
+data_root = './data'
+membership_path = os.path.join(data_root, 'membership.npz')
+out_daily = 'data_daily'
+
+
+def main():
+    configs = load_config()
+    # trading days per chunk read from the store, this sets the peak memory
+    chunk_days = configs.get('daily_chunk_days', 60)
+    rebalance = configs.get('daily_rebalance_days', 21)
+    window = configs.get('daily_window_days', 126)
+    report = RunReport.from_config('04_daily_factor')
+
+    store = Store(data_root)
+    store_daily = Store(out_daily)
+
+    codes = store.read('universe')['code'].tolist()
+    trade_cal = store.read('trade_cal')
+    days = np.sort(trade_cal.loc[trade_cal['is_open'] == 1, 'cal_date'].values)
+
+    financial_df = store.read('financial', columns=['ts_code', 'ann_date', 'end_date', 'npta', 'assets_yoy'], codes=codes)
+    membership = Universe.load(membership_path) if os.path.exists(membership_path) else None
+    stream = DailyFactorStream(codes, financial_df, window=window, rebalance=rebalance, membership=membership)
+
+    # every run rebuilds the daily outputs, chunk by chunk in date order
+    store_daily.remove('factor_daily')
+    store_daily.remove('exposure_daily')
+    for i in range(0, len(days), chunk_days):
+        start, end = days[i], days[min(i + chunk_days, len(days)) - 1]
+        with report.section('read'):
+            daily_df = store.read('daily', columns=['ts_code', 'trade_date', 'pct_chg'], codes=codes,
+                                  date_col='trade_date', start=start, end=end)
+            basic_df = store.read('basic', columns=['ts_code', 'trade_date', 'total_mv', 'pb'], codes=codes,
+                                  date_col='trade_date', start=start, end=end)
+        if daily_df.empty:
+            continue
+        with report.section('process'):
+            factor_df, exposure_df = stream.process(daily_df.dropna(subset=['pct_chg']), basic_df)
+        with report.section('write'):
+            store_daily.append('factor_daily', factor_df, date_col='date')
+            store_daily.append('exposure_daily', exposure_df, date_col='date')
+        report.rows('daily', len(daily_df))
+        report.rows('exposure_daily', len(exposure_df))
+    report.finish()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+import numpy as np
+import pandas as pd
+
+FACTOR_COLS = ['market', 'SMB', 'HML', 'RMW', 'CMA', 'UMD']
+
+
+def _matrix(returns):
+    """strategies x months array of a frame with one column per strategy, or of an array"""
+    if isinstance(returns, pd.DataFrame):
+        return returns.values.T.astype(np.float64)
+    return np.atleast_2d(np.asarray(returns, dtype=np.float64))
+
+
+def cumulative(returns):
+    """Value of 1 invested, strategies x months, missing months earn nothing"""
+    return np.cumprod(1 + np.nan_to_num(_matrix(returns)), axis=1)
+
+
+def high_water_mark(returns):
+    """Running maximum of the value, never below the initial 1"""
+    return np.maximum.accumulate(np.maximum(cumulative(returns), 1.), axis=1)
+
+
+def drawdown(returns):
+    """Fall of the value from its high-water mark, <= 0"""
+    return cumulative(returns) / high_water_mark(returns) - 1
+
+
+def max_drawdown(returns):
+    return drawdown(returns).min(axis=1)
+
+
+def sharpe(returns, periods=12):
+    """Annualised mean over standard deviation of returns that are already in excess of the risk-free rate"""
+    r = _matrix(returns)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.nanmean(r, axis=1) / np.nanstd(r, axis=1, ddof=1) * np.sqrt(periods)
+
+
+def sortino(returns, periods=12):
+    """Annualised mean over downside deviation"""
+    r = _matrix(returns)
+    downside = np.sqrt(np.nanmean(np.minimum(r, 0.) ** 2, axis=1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.nanmean(r, axis=1) / downside * np.sqrt(periods)
+
+
+def newey_west_lags(n):
+    """Newey-West lag of a sample of n months, element-wise for an array of samples"""
+    return np.floor(4 * (np.asarray(n) / 100.) ** (2. / 9)).astype(int)
+
+
+def regress(returns, factors, lags=None):
+    """OLS of every strategy on a constant and the factors, with Newey-West t-stats
+
+    returns is strategies x months, factors months x factors on the same
+    months. Each strategy uses the months where it and all factors are
+    known; the normal equations of all strategies are stacked and solved
+    in one batched call. Strategies with no more months than regressors
+    come back as NaN. Without lags, each strategy uses the Newey-West lag
+    of its own sample. Returns coefficients and t-stats, strategies x
+    (1 + factors), and the number of months used.
+    """
+    y = _matrix(returns)
+    x = np.column_stack([np.ones(len(factors)), np.asarray(factors, dtype=np.float64)])
+    used = ~np.isnan(y) & ~np.isnan(x).any(axis=1)
+    x = np.nan_to_num(x)
+    y = np.where(used, y, 0.)
+    n = used.sum(axis=1)
+    ok = n > x.shape[1]
+    used &= ok[:, None]
+
+    xtx = np.einsum('tp,st,tq->spq', x, used.astype(np.float64), x)
+    xty = np.einsum('tp,st->sp', x, y)
+    coef = np.full(xty.shape, np.nan)
+    coef[ok] = np.linalg.solve(xtx[ok], xty[ok][:, :, None])[:, :, 0]
+
+    # score of every strategy and month, zero outside its sample
+    resid = np.where(used, y - np.nan_to_num(coef) @ x.T, 0.)
+    score = resid[:, :, None] * x[None, :, :]
+    lags = newey_west_lags(n) if lags is None else np.full(len(n), lags)
+    meat = np.einsum('stp,stq->spq', score, score)
+    for lag in range(1, lags.max(initial=0) + 1):
+        gamma = np.einsum('stp,stq->spq', score[:, lag:], score[:, :-lag])
+        weight = np.where(lag <= lags, 1 - lag / (lags + 1.), 0.)
+        meat += weight[:, None, None] * (gamma + gamma.transpose(0, 2, 1))
+    cov = np.full(xtx.shape, np.nan)
+    bread = np.linalg.inv(xtx[ok])
+    cov[ok] = bread @ meat[ok] @ bread
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t_stat = coef / np.sqrt(np.diagonal(cov, axis1=1, axis2=2))
+    return coef, t_stat, n
+
+
+def summary(returns, factor_table=None, periods=12, lags=None):
+    """Performance and factor-model table of a frame of strategy returns, one column per strategy
+
+    factor_table has a date column and the FACTOR_COLS, the returns'
+    index holds the same dates.
+    """
+    r = _matrix(returns)
+    out = pd.DataFrame(index=returns.columns)
+    out['months'] = (~np.isnan(r)).sum(axis=1)
+    out['ann_return'] = (1 + np.nanmean(r, axis=1)) ** periods - 1
+    out['ann_vol'] = np.nanstd(r, axis=1, ddof=1) * np.sqrt(periods)
+    out['sharpe'] = sharpe(r, periods)
+    out['sortino'] = sortino(r, periods)
+    out['max_drawdown'] = max_drawdown(r)
+    if factor_table is not None:
+        factors = factor_table.set_index('date').reindex(returns.index)[FACTOR_COLS]
+        coef, t_stat, _ = regress(r, factors.values, lags)
+        out['alpha'], out['alpha_t'] = coef[:, 0], t_stat[:, 0]
+        for i, col in enumerate(FACTOR_COLS):
+            out['beta_' + col], out['t_' + col] = coef[:, i + 1], t_stat[:, i + 1]
+    return out
@@ -0,0 +1,118 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from datetime import datetime
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+HOUR = 3600
+DAY = 24 * HOUR
+
+# seconds a response stays fresh, by endpoint
+DEFAULT_TTLS = {
+    'trade_cal': 7 * DAY,
+    'stock_basic': DAY,
+    'index_weight': 7 * DAY,
+    'daily': 30 * DAY,
+    'daily_basic': 30 * DAY,
+    'index_daily': 30 * DAY,
+    'index_dailybasic': 30 * DAY,
+    'shibor': 30 * DAY,
+    # restatements change old reports
+    'fina_indicator': DAY,
+}
+
+
+class OfflineCacheMiss(Exception):
+    """Raised in offline mode when a request is not in the cache"""
+
+
+class ApiCache:
+    """Size-bounded LRU cache of pro_api responses on disk
+
+    Every response is one parquet file named after a hash of the endpoint and
+    its normalized parameters. The file mtime is when it was fetched (for the
+    TTL) and its atime when it was last served (for the LRU eviction).
+    """
+    def __init__(self, root, max_bytes=2 * 1024 ** 3, ttls=None, offline=False):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.offline = offline
+        self.lock = threading.Lock()
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+        self.entries = {}
+        for name in os.listdir(root):
+            if name.endswith('.parquet'):
+                stat = os.stat(os.path.join(root, name))
+                self.entries[name] = [stat.st_mtime, stat.st_atime, stat.st_size]
+        self.size = sum(entry[2] for entry in self.entries.values())
+
+    def key(self, api_name, params):
+        params = {k: str(v) for k, v in params.items() if v is not None}
+        digest = hashlib.sha1(json.dumps([api_name, params], sort_keys=True).encode()).hexdigest()
+        return f'{api_name}-{digest}.parquet'
+
+    def ttl(self, api_name, params):
+        ttl = self.ttls.get(api_name, DAY)
+        # a request reaching today may not have all of today's data yet
+        today = datetime.now().strftime('%Y%m%d')
+        if any(str(params.get(col) or '') >= today for col in ['end_date', 'trade_date', 'period']):
+            ttl = min(ttl, HOUR)
+        return ttl
+
+    def get(self, api_name, params):
+        """Cached response, None when missing or expired"""
+        name = self.key(api_name, params)
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is None:
+                if self.offline:
+                    raise OfflineCacheMiss(f'{api_name} {params} is not cached')
+                return None
+            now = time.time()
+            if not self.offline and now - entry[0] > self.ttl(api_name, params):
+                return None
+            entry[1] = now
+        path = os.path.join(self.root, name)
+        try:
+            os.utime(path, (entry[1], entry[0]))
+            return pq.read_table(path).to_pandas()
+        except FileNotFoundError:
+            # evicted by another worker since the lookup, a miss
+            with self.lock:
+                if self.entries.get(name) is entry:
+                    self.size -= self.entries.pop(name)[2]
+            if self.offline:
+                raise OfflineCacheMiss(f'{api_name} {params} is not cached')
+            return None
+
+    def put(self, api_name, params, df):
+        name = self.key(api_name, params)
+        path = os.path.join(self.root, name)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        pq.write_table(pa.Table.from_pandas(df, preserve_index=False), tmp_path)
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            size = os.path.getsize(path)
+            old = self.entries.get(name)
+            self.size += size - (old[2] if old else 0)
+            now = time.time()
+            self.entries[name] = [now, now, size]
+            self._evict()
+
+    def _evict(self):
+        # least recently served first
+        for name in sorted(self.entries, key=lambda name: self.entries[name][1]):
+            if self.size <= self.max_bytes:
+                break
+            self.size -= self.entries.pop(name)[2]
+            try:
+                os.remove(os.path.join(self.root, name))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,150 @@
+"""Jegadeesh-Titman momentum backtest over a grid of formation and holding periods
+
+    python backtest.py --formation 3 6 9 12 --holding 1 3 6 12 --costs 0 0.005 0.01
+
+The Python port of the strategy in RCode/analysis.R: the signal is the
+compounded excess return over the formation months, skipping the latest
+month, stocks are split into deciles every month, the top decile is bought
+and the bottom one sold, and every month's cohort is held for the holding
+months, overlapping with the cohorts before it. Lags run over the months of
+the panel rather than over each stock's own rows, and a cohort earns in a
+month only for the stocks with a return in that month.
+"""
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from storage import Store
+from panel import Panel
+from analytics import summary
+from instrument import RunReport
+
+
+def excess_returns(df):
+    """dates, codes, excess return matrix and its validity mask of a stock_factors_processed frame"""
+    panel = Panel.from_frame(df, fields=['return', 'rf'])
+    ret = panel.field('return').astype(np.float64) - panel.field('rf')
+    valid = panel.mask & ~np.isnan(ret)
+    return panel.dates, panel.codes, np.where(valid, ret, 0.), valid
+
+
+def _prefix(x):
+    """Prefix sums along the dates, with a leading row of zeros"""
+    out = np.zeros((x.shape[0] + 1,) + x.shape[1:], dtype=np.float64)
+    np.cumsum(x, axis=0, out=out[1:])
+    return out
+
+
+def momentum_signal(ret, valid, formation=6, skip=1):
+    """Compounded return over months t - skip - formation to t - skip - 1, NaN unless all of them have a return"""
+    log_sum = _prefix(np.where(valid, np.log1p(ret), 0.))
+    count = _prefix(valid)
+    signal = np.full(ret.shape, np.nan)
+    lag = skip + formation
+    if lag < ret.shape[0]:
+        t = np.arange(lag, ret.shape[0])
+        hi, lo = t - skip, t - lag
+        full = count[hi] - count[lo] == formation
+        signal[lag:] = np.where(full, np.expm1(log_sum[hi] - log_sum[lo]), np.nan)
+    return signal
+
+
+def decile_positions(signal, groups=10):
+    """+1 for the top group, -1 for the bottom group of every month, as dplyr's ntile splits them"""
+    has = ~np.isnan(signal)
+    order = np.argsort(np.where(has, signal, np.inf), axis=1, kind='stable')
+    rank = np.empty_like(order)
+    np.put_along_axis(rank, order, np.arange(signal.shape[1])[None, :], axis=1)
+    n = has.sum(axis=1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        group = np.where(has, np.floor(groups * rank / np.maximum(n, 1)) + 1, 0)
+    return ((group == groups).astype(np.int8) - (group == 1).astype(np.int8))
+
+
+def hold(positions, valid, holding):
+    """Portfolio weights of overlapping cohorts held for holding months
+
+    The weight of a stock is its net position summed over the live cohorts,
+    divided by the number of positions held in the month, like the R code.
+    """
+    net = _prefix(positions)
+    gross = _prefix(np.abs(positions))
+    t = np.arange(1, positions.shape[0] + 1)
+    lo = np.maximum(t - holding, 0)
+    net = (net[t] - net[lo]) * valid
+    count = ((gross[t] - gross[lo]) * valid).sum(axis=1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, net / count, 0.)
+
+
+def run(ret, valid, formation, holdings, costs, skip=1, groups=10):
+    """Gross return, turnover and net returns of one formation period and every holding period
+
+    Turnover is the sum of absolute weight changes from the previous month,
+    each cost level is charged per unit of turnover.
+    """
+    positions = decile_positions(momentum_signal(ret, valid, formation, skip), groups)
+    out = []
+    for holding in holdings:
+        weights = hold(positions, valid, holding)
+        gross = (weights * ret).sum(axis=1)
+        turnover = np.abs(np.diff(weights, axis=0, prepend=0.)).sum(axis=1)
+        for cost in costs:
+            out.append((formation, holding, cost, gross, turnover, gross - cost * turnover))
+    return out
+
+
+def sweep(df, formations=(6,), holdings=(6,), costs=(0.,), skip=1, groups=10, workers=1):
+    """Monthly returns of every (formation, holding, cost) combination as a long frame
+
+    Formation periods are spread over a process pool when workers > 1.
+    Months before the first position of a combination are left out.
+    """
+    dates, _, ret, valid = excess_returns(df)
+    args = [(ret, valid, formation, holdings, costs, skip, groups) for formation in formations]
+    if workers > 1 and len(formations) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(formations))) as executor:
+            results = list(executor.map(run, *zip(*args)))
+    else:
+        results = [run(*arg) for arg in args]
+
+    frames = []
+    for formation, holding, cost, gross, turnover, net in (row for result in results for row in result):
+        start = np.argmax(turnover > 0) if (turnover > 0).any() else len(dates)
+        frames.append(pd.DataFrame({'date': dates[start:], 'formation': formation, 'holding': holding, 'cost': cost,
+                                    'gross': gross[start:], 'turnover': turnover[start:], 'net': net[start:]}))
+    return pd.concat(frames, ignore_index=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--formation', type=int, nargs='+', default=[6], help='formation months J')
+    parser.add_argument('--holding', type=int, nargs='+', default=[1, 3, 6, 12], help='holding months K')
+    parser.add_argument('--costs', type=float, nargs='+', default=[0., 0.01], help='cost per unit of turnover')
+    parser.add_argument('--skip', type=int, default=1, help='latest months left out of the signal')
+    parser.add_argument('--groups', type=int, default=10)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--data', default='data_processed')
+    args = parser.parse_args()
+    report = RunReport.from_config('backtest')
+
+    report.lap('read')
+    store = Store(args.data)
+    df = store.read('stock_factors_processed', columns=['code', 'date', 'return', 'rf'])
+    report.lap('sweep')
+    result = sweep(df, args.formation, args.holding, args.costs, args.skip, args.groups, args.workers)
+    store.write('momentum_sweep', result)
+    report.rows('momentum_sweep', len(result))
+
+    report.lap('summary')
+    returns = result.pivot_table(index='date', columns=['formation', 'holding', 'cost'], values='net')
+    factors = store.read('factor_returns') if store.exists('factor_returns') else None
+    table = summary(returns, factors)
+    print(table[[col for col in ['months', 'ann_return', 'sharpe', 'max_drawdown', 'alpha', 'alpha_t'] if col in table]]
+          .to_string(float_format='%.4f'))
+    report.finish()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""Run the three pipeline stages against fake_tushare and report how they scale
+
+    python benchmark.py --stocks 300 1000 5000 --latency 0.05 --quota 2000
+
+Each stage runs in its own process inside a fresh work directory, the report
+holds wall time, peak RSS and rows/sec per stage and universe size.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import pyarrow.parquet as pq
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+STAGES = ['01_data_fetch.py', '02_data_process.py', '03_get_factor.py']
+
+# datasets a stage reads (or for the fetch, writes) to count its rows
+STAGE_ROWS = {
+    '01_data_fetch.py': [('data', 'daily'), ('data', 'basic'), ('data', 'financial')],
+    '02_data_process.py': [('data', 'daily'), ('data', 'basic'), ('data', 'financial')],
+    '03_get_factor.py': [('data_month', 'combined_all')],
+}
+
+
+def count_rows(work_dir, root, dataset):
+    path = os.path.join(work_dir, root, dataset)
+    if os.path.isfile(path + '.parquet'):
+        return pq.read_metadata(path + '.parquet').num_rows
+    rows = 0
+    for dir_path, _, names in os.walk(path):
+        for name in names:
+            if name.endswith('.parquet'):
+                rows += pq.read_metadata(os.path.join(dir_path, name)).num_rows
+    return rows
+
+
+def run_stage(script, work_dir, fake_args, log):
+    env = dict(os.environ, FAKE_TUSHARE=json.dumps(fake_args),
+               PYTHONPATH=os.pathsep.join([ROOT, os.environ.get('PYTHONPATH', '')]))
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, os.path.join(ROOT, 'fake_tushare.py'), os.path.join(ROOT, script)],
+                            cwd=work_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    wall = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise RuntimeError(f'{script} exited with {proc.returncode}, see {log.name}')
+    # ru_maxrss is in kilobytes on linux and bytes on macos
+    peak_rss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    return wall, peak_rss
+
+
+def run_benchmark(n_stocks, args):
+    work_dir = tempfile.mkdtemp(prefix=f'bench_{n_stocks}_', dir=args.work_dir)
+    os.makedirs(os.path.join(work_dir, 'configs'))
+    with open(os.path.join(work_dir, 'configs', 'config.yml'), 'w') as file:
+        file.write(f'token: fake\nfetch_mode: {args.fetch_mode}\nlimit_per_min: {args.quota}\n')
+
+    fake_args = {'n_stocks': n_stocks, 'start_date': args.start, 'end_date': args.end,
+                 'latency': args.latency, 'limit_per_min': args.quota, 'seed': args.seed}
+    results = []
+    with open(os.path.join(work_dir, 'log.txt'), 'w') as log:
+        for script in STAGES:
+            wall, peak_rss = run_stage(script, work_dir, fake_args, log)
+            rows = sum(count_rows(work_dir, root, dataset) for root, dataset in STAGE_ROWS[script])
+            results.append({
+                'stocks': n_stocks,
+                'stage': script,
+                'wall_s': round(wall, 3),
+                'peak_rss_mb': round(peak_rss / 1024 ** 2, 1),
+                'rows': rows,
+                'rows_per_s': round(rows / wall, 1) if wall > 0 else None,
+            })
+            print('%6d  %-20s %9.2fs %9.1fMB %12d rows %12.0f rows/s' % (
+                n_stocks, script, wall, results[-1]['peak_rss_mb'], rows, rows / wall))
+    if not args.keep:
+        shutil.rmtree(work_dir)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stocks', type=int, nargs='+', default=[300])
+    parser.add_argument('--start', default='20000101')
+    parser.add_argument('--end', default='20241231')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per fake request')
+    parser.add_argument('--quota', type=int, default=200, help='requests per minute per endpoint')
+    parser.add_argument('--fetch-mode', default='stock', choices=['stock', 'date'])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work-dir', default=None)
+    parser.add_argument('--keep', action='store_true', help='keep the work directories')
+    parser.add_argument('--report', default='bench_report.json')
+    args = parser.parse_args()
+
+    results = []
+    for n_stocks in args.stocks:
+        results += run_benchmark(n_stocks, args)
+    with open(args.report, 'w') as file:
+        json.dump({'args': vars(args), 'results': results}, file, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Check the outputs of an update against a full rebuild
+
+    python check_update.py          # after 02_data_process.py and 03_get_factor.py ran with update: true
+    python check_update.py --fake   # the same, with the stages run through fake_tushare.py
+
+Runs 02_data_process.py and 03_get_factor.py without update in a temporary
+work directory over the same ./data, then compares the monthly and factor
+datasets and the csv exports with the ones here, row for row, values up
+to float32 rounding. Exits with 1 when anything differs.
+"""
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+import pandas as pd
+import yaml
+from storage import Store
+from config import load_config
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+DATASETS = [('data_month', name) for name in ['stock_month', 'basic_month', 'fin_month', 'combined_all', 'market_month', 'shibor_month']] + \
+           [('data_processed', name) for name in ['stock_factors', 'stock_factors_processed', 'factor_returns']]
+CSVS = ['data_processed/stock_factors.csv', 'data_processed/stock_factors_processed.csv']
+
+
+def compare(df, rebuilt, rtol=1e-5, atol=1e-7):
+    """What differs between two frames, as messages, none when they match"""
+    if list(df.columns) != list(rebuilt.columns):
+        return [f'columns {list(df.columns)}, {list(rebuilt.columns)} in the rebuild']
+    if len(df) != len(rebuilt):
+        return [f'{len(df)} rows, {len(rebuilt)} in the rebuild']
+    out = []
+    for col in df.columns:
+        x, y = df[col], rebuilt[col]
+        if pd.api.types.is_numeric_dtype(x) and pd.api.types.is_numeric_dtype(y):
+            bad = ~np.isclose(x.to_numpy(dtype=np.float64), y.to_numpy(dtype=np.float64), rtol=rtol, atol=atol, equal_nan=True)
+        else:
+            bad = x.astype(str).to_numpy() != y.astype(str).to_numpy()
+        if bad.any():
+            out.append(f'{col}: {bad.sum()} rows differ, the first is row {np.argmax(bad)}')
+    return out
+
+
+def rebuild(work_dir, fake=False):
+    """Full run of the monthly and factor stages in work_dir over ./data"""
+    configs = load_config()
+    configs['update'] = False
+    os.makedirs(os.path.join(work_dir, 'configs'))
+    with open(os.path.join(work_dir, 'configs', 'config.yml'), 'w') as file:
+        yaml.safe_dump(configs, file, allow_unicode=True)
+    os.symlink(os.path.abspath('data'), os.path.join(work_dir, 'data'))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, os.environ.get('PYTHONPATH', '')]))
+    for script in ['02_data_process.py', '03_get_factor.py']:
+        command = [sys.executable] + ([os.path.join(ROOT, 'fake_tushare.py')] if fake else []) + [os.path.join(ROOT, script)]
+        subprocess.run(command, cwd=work_dir, env=env, check=True, stdout=subprocess.DEVNULL)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--fake', action='store_true', help='run the stages through fake_tushare.py')
+    parser.add_argument('--keep', action='store_true', help='keep the rebuild directory')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='rebuild_')
+    try:
+        rebuild(work_dir, args.fake)
+        failed = False
+        checks = [(f'{root}/{name}', Store(root).read(name), Store(os.path.join(work_dir, root)).read(name)) for root, name in DATASETS]
+        checks += [(path, pd.read_csv(path), pd.read_csv(os.path.join(work_dir, path))) for path in CSVS]
+        for name, df, rebuilt in checks:
+            problems = compare(df, rebuilt)
+            print(f'{name}: ' + ('; '.join(problems) if problems else f'{len(df)} rows match'))
+            failed |= bool(problems)
+    finally:
+        if args.keep:
+            print('rebuild in', work_dir)
+        else:
+            shutil.rmtree(work_dir)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
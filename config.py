@@ -0,0 +1,13 @@
+"""The run configuration, ./configs/config.yml of the work directory"""
+import os
+import yaml
+
+cfg_path = './configs/config.yml'
+
+
+def load_config(path=cfg_path):
+    """The config as a dict, empty when the file is missing"""
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as file:
+        return yaml.safe_load(file) or {}
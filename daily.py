@@ -0,0 +1,154 @@
+import numpy as np
+import pandas as pd
+from rolling import shift_months
+from factor_engine import DEFAULT_FACTORS, rank_legs
+
+EXPOSURES = ['size', 'value', 'profitability', 'investment', 'momentum']
+
+
+def _matrix(df, col, dates, code_index, date_col='trade_date', code_col='ts_code'):
+    """dates x codes matrix of a column of long rows, NaN where there is no row"""
+    out = np.full((len(dates), len(code_index)), np.nan)
+    n = pd.Index(list(code_index)).get_indexer(df[code_col])
+    keep = n >= 0
+    t = np.searchsorted(dates, df[date_col].values[keep])
+    out[t, n[keep]] = df[col].values[keep]
+    return out
+
+
+def _ffill(x, seed):
+    """Carry the last value down the rows, starting from the seed row"""
+    x = np.vstack([seed[None, :], x])
+    idx = np.where(np.isnan(x), 0, np.arange(len(x))[:, None])
+    np.maximum.accumulate(idx, axis=0, out=idx)
+    return x[idx, np.arange(x.shape[1])][1:]
+
+
+class FinancialState:
+    """Latest annual report of every stock known on a day, stepped forward through the days
+
+    A report is known from the first trading day after its ann_date (end_date
+    + 4 months without one), a report of an earlier period than the one held
+    does not replace it, and a report older than max_age_months is dropped.
+    """
+    def __init__(self, financial_df, code_index, periods=('1231',), max_age_months=18):
+        df = financial_df[financial_df['end_date'].astype(str).str[4:].isin(list(periods))]
+        df = df[df['ts_code'].isin(list(code_index))]
+        end_date = df['end_date'].astype(np.int64).values
+        lagged = shift_months(end_date, -4)
+        ann_date = df['ann_date'].astype(np.int64).values
+        known = np.where(ann_date > 0, ann_date, lagged)
+        order = np.lexsort((end_date, known))
+        self.known = known[order]
+        self.code = pd.Index(list(code_index)).get_indexer(df['ts_code'])[order].astype(np.int64)
+        self.end_date = end_date[order]
+        self.values = df[['npta', 'assets_yoy']].values[order].astype(np.float64)
+        self.max_age_months = max_age_months
+        self.pos = 0
+
+        n = len(code_index)
+        self.held_end = np.zeros(n, dtype=np.int64)
+        self.held = np.full((n, 2), np.nan)
+
+    def step(self, date):
+        """npta and assets_yoy of every stock on date"""
+        stop = np.searchsorted(self.known, date, side='left')
+        for i in range(self.pos, stop):
+            code = self.code[i]
+            if self.end_date[i] >= self.held_end[code]:
+                self.held_end[code] = self.end_date[i]
+                self.held[code] = self.values[i]
+        self.pos = max(self.pos, stop)
+        fresh = shift_months(self.held_end, -self.max_age_months) >= date
+        return np.where(fresh[:, None], self.held, np.nan)
+
+
+class DailyFactorStream:
+    """Daily factor returns and exposures from daily bars streamed in date order
+
+    Feed it chunks of daily and daily_basic rows covering consecutive trading
+    days, it keeps only what the next chunk needs: the last window days of
+    returns for momentum, the last total_mv and pb of every stock, the
+    financial reports known so far and the current portfolio legs. Legs are
+    formed from the exposures at the close of every rebalance-th day, among
+    the members of the universe that day when a membership is given, and
+    earn from the next day on, as equal-weighted long-short returns.
+    """
+    def __init__(self, codes, financial_df, window=126, rebalance=21, days=220, factors=DEFAULT_FACTORS, fin_options=None,
+                 membership=None):
+        self.codes = list(codes)
+        self.membership = membership
+        self.code_index = {code: i for i, code in enumerate(self.codes)}
+        self.window = window
+        self.rebalance = rebalance
+        self.days = days
+        self.factors = factors
+        self.fin = FinancialState(financial_df, self.code_index, **(fin_options or {}))
+
+        n = len(self.codes)
+        self.log_ret = np.zeros((0, n))
+        self.has_ret = np.zeros((0, n), dtype=bool)
+        self.last_basic = np.full((2, n), np.nan)
+        self.legs = np.zeros((len(factors), n), dtype=np.int8)
+        self.day = 0
+
+    def _momentum(self, log_ret, has_ret, start):
+        """Annualised mean log return over the window days ending on every row from start on"""
+        log_sum = np.vstack([np.zeros((1, log_ret.shape[1])), np.cumsum(log_ret, axis=0)])
+        count = np.vstack([np.zeros((1, log_ret.shape[1])), np.cumsum(has_ret, axis=0)])
+        hi = np.arange(start, len(log_ret)) + 1
+        lo = np.maximum(hi - self.window, 0)
+        n = count[hi] - count[lo]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(n > 0, np.exp((log_sum[hi] - log_sum[lo]) / n * self.days) - 1, np.nan)
+
+    def process(self, daily_df, basic_df):
+        """Factor returns and exposures of the trading days in a chunk, as two frames"""
+        dates = np.sort(daily_df['trade_date'].unique())
+        ret = _matrix(daily_df, 'pct_chg', dates, self.code_index) / 100
+        has_ret = ~np.isnan(ret)
+        mv = _ffill(_matrix(basic_df, 'total_mv', dates, self.code_index), self.last_basic[0])
+        pb = _ffill(_matrix(basic_df, 'pb', dates, self.code_index), self.last_basic[1])
+        self.last_basic = np.vstack([mv[-1], pb[-1]])
+
+        # the window of returns carried over from the chunk before, then this chunk's
+        log_ret = np.vstack([self.log_ret, np.where(has_ret, np.log1p(np.nan_to_num(ret)), 0.)])
+        has_all = np.vstack([self.has_ret, has_ret])
+        momentum = self._momentum(log_ret, has_all, len(self.log_ret))
+        self.log_ret, self.has_ret = log_ret[-self.window:], has_all[-self.window:]
+
+        fin = np.stack([self.fin.step(int(date)) for date in dates])
+        with np.errstate(divide='ignore'):
+            x = np.stack([mv / 1e8, 1. / pb, fin[:, :, 0] / 100, fin[:, :, 1] / 100, momentum])
+        cols = [EXPOSURES.index(factor['col']) for factor in self.factors.values()]
+
+        # legs only change at the close of a rebalance day, every block of days between two earns on fixed legs
+        starts = [0] + [t + 1 for t in range(len(dates)) if (self.day + t) % self.rebalance == 0]
+        ends = starts[1:] + [len(dates)]
+        ret_filled, counted = np.where(has_ret, ret, 0.), has_ret.astype(np.float64)
+        factor_ret = np.full((len(dates), len(self.factors)), np.nan)
+        for lo, hi in zip(starts, ends):
+            if lo > 0:
+                t = lo - 1
+                valid = has_ret[t] & ~np.isnan(x[:, t]).any(axis=0)
+                if self.membership is not None:
+                    valid &= self.membership.mask([dates[t]], self.codes)[0]
+                for i, factor in enumerate(self.factors.values()):
+                    self.legs[i] = rank_legs(x[cols[i], t], valid, factor)
+            if lo < hi:
+                top, bot = (self.legs == 1).astype(np.float64), (self.legs == -1).astype(np.float64)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    factor_ret[lo:hi] = (ret_filled[lo:hi] @ top.T) / (counted[lo:hi] @ top.T) - \
+                        (ret_filled[lo:hi] @ bot.T) / (counted[lo:hi] @ bot.T)
+        self.day += len(dates)
+
+        factor_df = pd.DataFrame(factor_ret, columns=list(self.factors))
+        factor_df.insert(0, 'n_stocks', has_ret.sum(axis=1))
+        factor_df.insert(0, 'date', dates)
+
+        # exposures at the close of every day a stock traded
+        t, n = np.nonzero(has_ret)
+        exposure_df = pd.DataFrame({'code': np.asarray(self.codes, dtype=object)[n], 'date': dates[t]})
+        for j, col in enumerate(EXPOSURES):
+            exposure_df[col] = x[j, t, n]
+        return factor_df, exposure_df
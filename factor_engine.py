@@ -0,0 +1,136 @@
+import numpy as np
+import pandas as pd
+
+# long-short factors: the legs are the first and last ratio of the stocks sorted by col
+DEFAULT_FACTORS = {
+    'SMB': {'col': 'size', 'ratio': 0.5, 'ascending': True},
+    'HML': {'col': 'value', 'ratio': 0.3, 'ascending': False},
+    'RMW': {'col': 'profitability', 'ratio': 0.3, 'ascending': False},
+    'CMA': {'col': 'investment', 'ratio': 0.3, 'ascending': False},
+    'UMD': {'col': 'momentum', 'ratio': 0.3, 'ascending': False},
+}
+
+
+def formation_dates(dates, months=(4,), start=None):
+    """Rebalance dates YYYYMM01: the given calendar months of every year the dates span, from start on
+
+    A rebalance month without data still starts a new (empty) holding period.
+    """
+    years = np.asarray(dates).astype(np.int64) // 10000
+    if len(years) == 0:
+        return np.zeros(0, dtype=np.int64)
+    rebalance = np.array([year * 10000 + month * 100 + 1 for year in range(years.min(), years.max() + 1)
+                          for month in sorted(months)], dtype=np.int64)
+    if start is not None:
+        rebalance = rebalance[rebalance >= int(start)]
+    return rebalance
+
+
+def leg_membership(panel, factor, rebalance):
+    """Leg of every code at every rebalance date, rebalance x codes, 1 for the top leg, -1 for the bottom one
+
+    Codes are ranked on the factor's column among the valid cells of the
+    cross section, ties keep the panel's code order.
+    """
+    col = panel.field(factor['col'])
+    legs = np.zeros((len(rebalance), len(panel.codes)), dtype=np.int8)
+    for i, date in enumerate(rebalance):
+        if date in panel.date_index:
+            t = panel.date_index[date]
+            legs[i] = rank_legs(col[t], panel.mask[t], factor)
+    return legs
+
+
+def rank_legs(x, valid, factor):
+    """Legs of one cross section, ranked among the valid non-NaN values, ties in position order"""
+    legs = np.zeros(len(x), dtype=np.int8)
+    valid = np.flatnonzero(valid & ~np.isnan(x))
+    order = valid[np.argsort(x[valid] if factor['ascending'] else -x[valid], kind='stable')]
+    k = int(len(valid) * factor['ratio'])
+    if k > 0:
+        legs[order[:k]] = 1
+        legs[order[-k:]] = -1
+    return legs
+
+
+def _leg_mean(ret, member):
+    """Mean return of the member cells of every date, NaN for an empty leg, summed in float64"""
+    count = member.sum(axis=1)
+    total = np.where(member, ret, 0.).sum(axis=1, dtype=np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, total / count, np.nan)
+
+
+def factor_returns(panel, factors=DEFAULT_FACTORS, months=(4,), start=None, ret_field='return', state=None):
+    """Long-short returns of every factor for every month, as a date x factor table
+
+    Portfolios are formed in the rebalance months and held until the next
+    rebalance, a leg's return is the equal-weighted mean return of its
+    stocks that have a row in the month. With the holding_state of the
+    months before the panel, the panel's months up to its first rebalance
+    are held in the state's legs, as a run over the whole history would.
+    """
+    rebalance = formation_dates(panel.dates, months, start)
+    legs = {name: leg_membership(panel, factor, rebalance) for name, factor in factors.items()}
+    if state is not None:
+        later = rebalance > state['date']
+        rebalance = np.r_[state['date'], rebalance[later]]
+        carried = _carry(state, panel.codes)
+        legs = {name: np.vstack([carried[name][None, :], legs[name][later]]) for name in factors}
+    formed = np.searchsorted(rebalance, panel.dates, side='right') - 1
+    held = formed >= 0
+
+    ret = panel.field(ret_field)[held]
+    valid = panel.mask[held] & ~np.isnan(ret)
+    table = pd.DataFrame({'date': panel.dates[held]})
+    for name in factors:
+        member = legs[name][formed[held]]
+        table[name] = _leg_mean(ret, valid & (member == 1)) - _leg_mean(ret, valid & (member == -1))
+    return table
+
+
+def holding_state(panel, factors=DEFAULT_FACTORS, months=(4,), start=None, state=None):
+    """Legs of the last rebalance on or before the panel's last date, what the next months are held in
+
+    The state of the months before the panel is kept when the panel has no
+    rebalance of its own, or no months at all, None before the first rebalance.
+    """
+    if len(panel.dates) == 0:
+        return state
+    rebalance = formation_dates(panel.dates, months, start)
+    rebalance = rebalance[rebalance <= panel.dates.max()]
+    if state is not None:
+        rebalance = rebalance[rebalance > state['date']]
+    if len(rebalance) == 0:
+        return state
+    date = rebalance[-1]
+    return {'date': int(date), 'codes': np.asarray(panel.codes).astype(str), 'factors': list(factors),
+            'legs': np.stack([leg_membership(panel, factor, [date])[0] for factor in factors.values()])}
+
+
+def _carry(state, codes):
+    """The state's legs of every factor over codes, 0 for codes the state does not hold"""
+    col = pd.Index(state['codes']).get_indexer(np.asarray(codes).astype(str))
+    return {name: np.where(col >= 0, state['legs'][i][np.maximum(col, 0)], 0).astype(np.int8)
+            for i, name in enumerate(state['factors'])}
+
+
+def save_state(path, state, last_month):
+    """Write a holding_state and the last month it has seen to an .npz file"""
+    if state is None:
+        state = {'date': 0, 'codes': np.zeros(0, dtype=str), 'factors': [], 'legs': np.zeros((0, 0), dtype=np.int8)}
+    np.savez(path, last_month=last_month, date=state['date'], codes=state['codes'], factors=np.asarray(state['factors'], dtype=str),
+             legs=state['legs'])
+
+
+def load_state(path):
+    """The holding_state and last month of save_state"""
+    with np.load(path) as data:
+        state = {'date': int(data['date']), 'codes': data['codes'], 'factors': data['factors'].tolist(), 'legs': data['legs']}
+        return (state if state['date'] > 0 else None), int(data['last_month'])
+
+
+def broadcast(df, table, cols=('code', 'date', 'return', 'market', 'rf')):
+    """Stock rows of the months in the factor table, with the month's factor returns on every row, in date order"""
+    out = df[list(cols)].merge(table, on='date', how='inner')
+    return out.sort_values(by='date', kind='stable').reset_index(drop=True)
@@ -0,0 +1,336 @@
+"""Synthetic stand-in for tushare's pro_api
+
+Generates deterministic market data for a configurable number of stocks and
+date range, with the endpoints TushareFetcher uses, per-request row caps,
+latency and a per-minute rate limit.
+
+    python fake_tushare.py 01_data_fetch.py
+
+runs a pipeline script against it, configured through the FAKE_TUSHARE
+environment variable (json of FakeProApi arguments).
+"""
+import os
+import sys
+import json
+import time
+import runpy
+import threading
+from collections import deque
+import numpy as np
+import pandas as pd
+
+# rows returned by one request, as the real server caps them
+ROW_CAPS = {
+    'daily': 6000,
+    'daily_basic': 6000,
+    'index_daily': 8000,
+    'index_dailybasic': 3000,
+    'fina_indicator': 100,
+    'shibor': 2000,
+    'index_weight': 6000,
+}
+
+DAILY_FIELDS = 'ts_code,trade_date,open,high,low,close,pre_close,change,pct_chg,vol,amount'
+BASIC_FIELDS = 'ts_code,trade_date,close,turnover_rate,volume_ratio,pe,pe_ttm,pb,dv_ratio,dv_ttm,total_share,float_share,total_mv,circ_mv'
+FINA_FIELDS = 'ts_code,ann_date,end_date,eps,current_ratio,quick_ratio,roe,roa,npta,assets_yoy,bps,debt_to_assets'
+INDUSTRIES = ['银行', '保险', '电子', '医药', '食品饮料', '机械', '化工', '汽车', '计算机', '房地产']
+
+
+class FakeProApi:
+    def __init__(self, n_stocks=300, start_date='20000101', end_date='20241231', latency=0.,
+                 limit_per_min=None, index_size=None, delisted_ratio=0.05, seed=0):
+        self.n_stocks = n_stocks
+        self.latency = latency
+        self.limit_per_min = limit_per_min
+        self.index_size = index_size or n_stocks
+        self.seed = seed
+        self.calls = {}
+        self.lock = threading.Lock()
+
+        rng = np.random.default_rng(seed)
+        days = pd.bdate_range(pd.Timestamp(start_date), pd.Timestamp(end_date))
+        # new year and national day weeks are closed
+        closed = ((days.month == 1) & (days.day <= 3)) | ((days.month == 10) & (days.day <= 7))
+        self.all_days = days.strftime('%Y%m%d').values
+        self.is_open = ~closed
+        self.dates = self.all_days[self.is_open]
+        n_days = len(self.dates)
+
+        codes = np.arange(1, n_stocks + 1)
+        self.codes = np.array(['%06d.%s' % (600000 + c if c % 2 else c, 'SH' if c % 2 else 'SZ') for c in codes])
+        self.code_pos = {code: i for i, code in enumerate(self.codes)}
+
+        # listing and delisting days as indexes into self.dates
+        self.list_idx = np.where(rng.random(n_stocks) < 0.6, 0, rng.integers(0, n_days * 3 // 4, n_stocks))
+        self.delist_idx = np.full(n_stocks, n_days)
+        delisted = rng.random(n_stocks) < delisted_ratio
+        self.delist_idx[delisted] = np.minimum(n_days, self.list_idx[delisted] + rng.integers(250, n_days, delisted.sum()))
+        self.industry = rng.choice(INDUSTRIES, n_stocks, p=[0.05, 0.02] + [0.93 / 8] * 8)
+        self.total_share = rng.lognormal(21, 1, n_stocks)
+        self.base_price = rng.lognormal(2, 0.6, n_stocks)
+        self.book_ps = self.base_price / rng.uniform(1, 6, n_stocks)
+
+        self.returns = None
+        self.index_returns = {}
+
+    # ---- generated panels ----
+    def _panel(self):
+        """Daily returns and prices of every stock, built on first use"""
+        with self.lock:
+            if self.returns is None:
+                rng = np.random.default_rng(self.seed + 1)
+                n_days = len(self.dates)
+                market = rng.normal(0.0003, 0.014, n_days)
+                beta = rng.uniform(0.6, 1.4, self.n_stocks)
+                returns = market[:, None] * beta[None, :] + rng.normal(0, 0.02, (n_days, self.n_stocks))
+                returns = np.clip(returns, -0.1, 0.1).astype(np.float32)
+                self.close = (self.base_price[None, :] * np.exp(np.cumsum(np.log1p(returns), axis=0))).astype(np.float32)
+                self.market = market
+                self.returns = returns
+        return self.returns, self.close
+
+    def _alive(self, pos, day_idx):
+        return (day_idx >= self.list_idx[pos]) & (day_idx < self.delist_idx[pos])
+
+    def _bars(self, pos, day_idx):
+        """daily and daily_basic rows for matching arrays of stock positions and day indexes"""
+        returns, close = self._panel()
+        ret = returns[day_idx, pos].astype(np.float64)
+        close = close[day_idx, pos].astype(np.float64)
+        pre_close = close / (1 + ret)
+        h = np.abs(np.sin(day_idx * 12.9898 + pos * 78.233))
+        share = self.total_share[pos]
+        book = self.book_ps[pos] * (1.08 ** (day_idx / 250.))
+        return pd.DataFrame({
+            'ts_code': self.codes[pos],
+            'trade_date': self.dates[day_idx],
+            'open': pre_close * (1 + (h - 0.5) * 0.01),
+            'high': np.maximum(close, pre_close) * (1 + h * 0.01),
+            'low': np.minimum(close, pre_close) * (1 - h * 0.01),
+            'close': close,
+            'pre_close': pre_close,
+            'change': close - pre_close,
+            'pct_chg': ret * 100,
+            'vol': share / 1e4 * (0.005 + h * 0.02),
+            'amount': share / 1e4 * (0.005 + h * 0.02) * close / 10,
+            'turnover_rate': (0.5 + h * 2),
+            'volume_ratio': 0.5 + h,
+            'pe': close * 10 / book,
+            'pe_ttm': close * 11 / book,
+            'pb': close / book,
+            'dv_ratio': h * 3,
+            'dv_ttm': h * 3,
+            'total_share': share / 1e4,
+            'float_share': share / 1e4 * 0.8,
+            'total_mv': share * close / 1e4,
+            'circ_mv': share * close / 1e4 * 0.8,
+        })
+
+    # ---- server behaviour ----
+    def _call(self, api_name):
+        now = time.monotonic()
+        with self.lock:
+            calls = self.calls.setdefault(api_name, deque())
+            while calls and now - calls[0] > 60:
+                calls.popleft()
+            if self.limit_per_min is not None and len(calls) >= self.limit_per_min:
+                raise Exception(f'抱歉，您每分钟最多访问该接口{self.limit_per_min}次，权限的具体详情访问：https://tushare.pro/document/1?doc_id=108。')
+            calls.append(now)
+        if self.latency:
+            time.sleep(self.latency * (0.5 + np.random.random()))
+
+    def _respond(self, api_name, df, fields, default_fields, limit=None, offset=0):
+        fields = [f for f in (fields or default_fields).split(',') if f in df.columns]
+        cap = ROW_CAPS.get(api_name)
+        limit = min(int(limit), cap) if limit is not None and cap else (int(limit) if limit is not None else cap)
+        offset = int(offset or 0)
+        df = df[fields].iloc[offset:offset + limit if limit else None]
+        return df.reset_index(drop=True)
+
+    def _day_range(self, start_date=None, end_date=None, trade_date=None):
+        if trade_date is not None:
+            return np.flatnonzero(self.dates == str(trade_date))
+        lo = np.searchsorted(self.dates, str(start_date or '0'))
+        hi = np.searchsorted(self.dates, str(end_date or '99999999'), side='right')
+        return np.arange(lo, hi)
+
+    def _stock_rows(self, ts_code, start_date, end_date, trade_date):
+        day_idx = self._day_range(start_date, end_date, trade_date)
+        if ts_code is not None:
+            pos = np.array([self.code_pos[c] for c in str(ts_code).split(',') if c in self.code_pos], dtype=int)
+        else:
+            pos = np.arange(self.n_stocks)
+        pos_grid, day_grid = np.meshgrid(pos, day_idx[::-1], indexing='ij')
+        pos_grid, day_grid = pos_grid.ravel(), day_grid.ravel()
+        keep = self._alive(pos_grid, day_grid)
+        return self._bars(pos_grid[keep], day_grid[keep])
+
+    # ---- endpoints ----
+    def trade_cal(self, exchange='', start_date=None, end_date=None, is_open=None, fields=None, **kwargs):
+        self._call('trade_cal')
+        df = pd.DataFrame({'exchange': 'SSE', 'cal_date': self.all_days, 'is_open': self.is_open.astype(int)})
+        df = df[(df['cal_date'] >= str(start_date or '0')) & (df['cal_date'] <= str(end_date or '99999999'))]
+        if is_open is not None and str(is_open) != '':
+            df = df[df['is_open'] == int(is_open)]
+        return self._respond('trade_cal', df.iloc[::-1], fields, 'exchange,cal_date,is_open')
+
+    def stock_basic(self, exchange='', list_status='L', fields=None, **kwargs):
+        self._call('stock_basic')
+        status = np.where(self.delist_idx < len(self.dates), 'D', 'L')
+        df = pd.DataFrame({
+            'ts_code': self.codes,
+            'symbol': [c[:6] for c in self.codes],
+            'name': ['股票%04d' % i for i in range(self.n_stocks)],
+            'area': '上海',
+            'industry': self.industry,
+            'list_date': self.dates[self.list_idx],
+            'list_status': status,
+            'delist_date': np.where(status == 'D', self.dates[np.minimum(self.delist_idx, len(self.dates) - 1)], None),
+        })
+        if list_status:
+            df = df[df['list_status'] == list_status]
+        return self._respond('stock_basic', df, fields, 'ts_code,symbol,name,area,industry,list_date')
+
+    def daily(self, ts_code=None, trade_date=None, start_date=None, end_date=None, fields=None, limit=None, offset=0, **kwargs):
+        self._call('daily')
+        df = self._stock_rows(ts_code, start_date, end_date, trade_date)
+        return self._respond('daily', df, fields, DAILY_FIELDS, limit, offset)
+
+    def daily_basic(self, ts_code=None, trade_date=None, start_date=None, end_date=None, fields=None, limit=None, offset=0, **kwargs):
+        self._call('daily_basic')
+        df = self._stock_rows(ts_code, start_date, end_date, trade_date)
+        return self._respond('daily_basic', df, fields, BASIC_FIELDS, limit, offset)
+
+    def _index_rows(self, ts_code, day_idx):
+        self._panel()
+        with self.lock:
+            if ts_code not in self.index_returns:
+                rng = np.random.default_rng(self.seed + sum(map(ord, ts_code)))
+                ret = np.clip(self.market + rng.normal(0, 0.002, len(self.dates)), -0.1, 0.1)
+                self.index_returns[ts_code] = (ret, 1000 * np.exp(np.cumsum(np.log1p(ret))))
+        ret, close = self.index_returns[ts_code]
+        pre_close = close[day_idx] / (1 + ret[day_idx])
+        return pd.DataFrame({
+            'ts_code': ts_code,
+            'trade_date': self.dates[day_idx],
+            'open': pre_close,
+            'high': np.maximum(close[day_idx], pre_close),
+            'low': np.minimum(close[day_idx], pre_close),
+            'close': close[day_idx],
+            'pre_close': pre_close,
+            'change': close[day_idx] - pre_close,
+            'pct_chg': ret[day_idx] * 100,
+            'vol': 1e8,
+            'amount': 1e9,
+        })
+
+    def index_daily(self, ts_code=None, trade_date=None, start_date=None, end_date=None, fields=None, limit=None, offset=0, **kwargs):
+        self._call('index_daily')
+        df = self._index_rows(ts_code, self._day_range(start_date, end_date, trade_date)[::-1])
+        return self._respond('index_daily', df, fields, DAILY_FIELDS, limit, offset)
+
+    def index_dailybasic(self, ts_code=None, trade_date=None, start_date=None, end_date=None, fields=None, limit=None, offset=0, **kwargs):
+        self._call('index_dailybasic')
+        codes = [ts_code] if ts_code else ['000001.SH', '000300.SH', '399300.SZ']
+        df = pd.concat([self._index_rows(c, self._day_range(start_date, end_date, trade_date)[::-1]) for c in codes])
+        df['pe'] = df['pe_ttm'] = 15.
+        df['pb'] = 1.5
+        df['turnover_rate'] = 1.
+        df['total_share'] = df['float_share'] = df['total_mv'] = 1e12
+        return self._respond('index_dailybasic', df, fields, 'ts_code,trade_date,turnover_rate,pe,pe_ttm,pb,total_share,float_share,total_mv', limit, offset)
+
+    def _reports(self, pos):
+        """Quarterly reports of one stock, a few of them restated later"""
+        rng = np.random.default_rng(self.seed + 1000 + pos)
+        first = int(self.dates[self.list_idx[pos]][:4]) - 1
+        last = int(self.dates[min(self.delist_idx[pos], len(self.dates)) - 1][:4])
+        rows = []
+        for year in range(first, last + 1):
+            for period, ann in [('0331', '%d0428'), ('0630', '%d0828'), ('0930', '%d1028'), ('1231', '%d0425')]:
+                ann_year = year + 1 if period == '1231' else year
+                roe = rng.normal(10, 6)
+                row = {
+                    'ts_code': self.codes[pos],
+                    'ann_date': ann % ann_year,
+                    'end_date': '%d%s' % (year, period),
+                    'eps': rng.normal(0.5, 0.3),
+                    'current_ratio': rng.uniform(0.5, 3),
+                    'quick_ratio': rng.uniform(0.3, 2),
+                    'roe': roe,
+                    'roa': roe * rng.uniform(0.2, 0.6),
+                    'npta': roe * rng.uniform(0.2, 0.6),
+                    'assets_yoy': rng.normal(10, 15),
+                    'bps': self.book_ps[pos] * 1.08 ** (year - first),
+                    'debt_to_assets': rng.uniform(20, 80),
+                }
+                rows.append(row)
+                if rng.random() < 0.05:
+                    restated = dict(row, roe=roe * rng.uniform(0.8, 1.2))
+                    restated['ann_date'] = '%d0630' % (ann_year + 1)
+                    rows.append(restated)
+        df = pd.DataFrame(rows)
+        return df[df['ann_date'] <= self.dates[-1]]
+
+    def fina_indicator(self, ts_code=None, ann_date=None, start_date=None, end_date=None, period=None, fields=None, limit=None, offset=0, **kwargs):
+        self._call('fina_indicator')
+        df = self._reports(self.code_pos[ts_code]).iloc[::-1]
+        if period is not None:
+            df = df[df['end_date'] == str(period)]
+        if ann_date is not None:
+            df = df[df['ann_date'] == str(ann_date)]
+        if start_date is not None:
+            df = df[df['ann_date'] >= str(start_date)]
+        if end_date is not None:
+            df = df[df['ann_date'] <= str(end_date)]
+        return self._respond('fina_indicator', df, fields, FINA_FIELDS, limit, offset)
+
+    def shibor(self, date=None, start_date=None, end_date=None, fields=None, limit=None, offset=0, **kwargs):
+        self._call('shibor')
+        day_idx = self._day_range(start_date, end_date, date)
+        day_idx = day_idx[self.dates[day_idx] >= '20061008'][::-1]
+        level = 2.5 + np.sin(day_idx / 500.)
+        df = pd.DataFrame({'date': self.dates[day_idx]})
+        for i, tenor in enumerate(['on', '1w', '2w', '1m', '3m', '6m', '9m', '1y']):
+            df[tenor] = level + i * 0.1
+        return self._respond('shibor', df, fields, 'date,on,1w,2w,1m,3m,6m,9m,1y', limit, offset)
+
+    def index_weight(self, index_code=None, trade_date=None, start_date=None, end_date=None, fields=None, limit=None, offset=0, **kwargs):
+        """Month-end snapshots, the index holds the index_size largest listed stocks of the month"""
+        self._call('index_weight')
+        _, close = self._panel()
+        months = self.dates.astype('U6')
+        month_end = np.flatnonzero(np.r_[months[1:] != months[:-1], True])
+        if trade_date is not None:
+            # the snapshot of the month holding trade_date
+            snaps = month_end[months[month_end] == str(trade_date)[:6]]
+        else:
+            snaps = month_end[(self.dates[month_end] >= str(start_date or '0')) & (self.dates[month_end] <= str(end_date or '99999999'))]
+        frames = []
+        for day in snaps[::-1]:
+            pos = np.flatnonzero(self._alive(np.arange(self.n_stocks), day))
+            mv = close[day, pos] * self.total_share[pos]
+            largest = np.argsort(-mv, kind='stable')[:self.index_size]
+            members, weight = pos[largest], mv[largest]
+            frames.append(pd.DataFrame({
+                'index_code': index_code,
+                'con_code': self.codes[members],
+                'trade_date': self.dates[day],
+                'weight': weight / weight.sum() * 100,
+            }))
+        df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['index_code', 'con_code', 'trade_date', 'weight'])
+        return self._respond('index_weight', df, fields, 'index_code,con_code,trade_date,weight', limit, offset)
+
+
+def install(**kwargs):
+    """Make tushare.pro_api return a FakeProApi"""
+    import tushare
+    api = FakeProApi(**kwargs)
+    tushare.pro_api = lambda token=None, **_: api
+    return api
+
+
+if __name__ == '__main__':
+    install(**json.loads(os.environ.get('FAKE_TUSHARE', '{}')))
+    script = sys.argv[1]
+    sys.argv = sys.argv[1:]
+    runpy.run_path(script, run_name='__main__')
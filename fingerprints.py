@@ -0,0 +1,79 @@
+"""Fingerprints of code, parameters and files, for deciding what has to be rebuilt
+
+Kept free of the stages and the DAG, so importing it does not put them
+into the fingerprint of the code that uses it.
+"""
+import os
+import ast
+import json
+import hashlib
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def fingerprint(*parts):
+    """sha1 of json-serialisable parts"""
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def local_modules(script, root=ROOT):
+    """The script and every module of root it imports, directly or not"""
+    seen, todo = set(), [script]
+    while todo:
+        name = todo.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        with open(os.path.join(root, name), 'r', encoding='utf-8') as file:
+            tree = ast.parse(file.read())
+        for node in ast.walk(tree):
+            modules = [alias.name for alias in node.names] if isinstance(node, ast.Import) else \
+                [node.module] if isinstance(node, ast.ImportFrom) and node.module else []
+            for module in modules:
+                path = module.split('.')[0] + '.py'
+                if os.path.exists(os.path.join(root, path)):
+                    todo.append(path)
+    return sorted(seen)
+
+
+def code_fingerprint(script, root=ROOT):
+    """Hash of the source of a module and every local module it imports"""
+    parts = []
+    for module in local_modules(script, root):
+        with open(os.path.join(root, module), 'rb') as file:
+            parts.append((module, hashlib.sha1(file.read()).hexdigest()))
+    return fingerprint(parts)
+
+
+class FileHashes:
+    """Content hashes of files and directories, cached on (size, mtime) in a State"""
+    def __init__(self, state):
+        self.state = state
+
+    def file(self, path):
+        stat = os.stat(path)
+        key = '%d:%d' % (stat.st_size, stat.st_mtime_ns)
+        cached = self.state.get('files', path)
+        if cached is not None and cached.startswith(key + ':'):
+            return cached.rsplit(':', 1)[1]
+        sha = hashlib.sha1()
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                sha.update(block)
+        self.state.set('files', path, key + ':' + sha.hexdigest())
+        return sha.hexdigest()
+
+    def path(self, path):
+        """Hash of a file, or of every file under a directory with its relative path, None if missing"""
+        if os.path.isfile(path):
+            return self.file(path)
+        if not os.path.isdir(path):
+            return None
+        parts = []
+        for dir_path, dir_names, names in os.walk(path):
+            dir_names.sort()
+            for name in sorted(names):
+                if not name.endswith('.tmp'):
+                    full = os.path.join(dir_path, name)
+                    parts.append((os.path.relpath(full, path), self.file(full)))
+        return fingerprint(parts)
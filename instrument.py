@@ -0,0 +1,210 @@
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from config import load_config
+try:
+    import resource
+except ImportError:
+    # windows, peak memory is then only sampled from this process
+    resource = None
+
+
+def current_rss():
+    """Resident set size of this process in bytes, the peak so far where /proc is not available"""
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return _peak_rss('self')
+
+
+def _peak_rss(who):
+    if resource is None:
+        return 0
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in kilobytes on linux and bytes on macos
+    return usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+class SamplingProfiler:
+    """Samples the stack of one thread at a fixed interval and counts the functions on it
+
+    self counts the function running at the sample, total every function on
+    the stack, so total / samples is the share of time spent inside it.
+    """
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = 0
+        self.self_counts = Counter()
+        self.total_counts = Counter()
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is None:
+            return
+        self.samples += 1
+        self.self_counts[_where(frame)] += 1
+        seen = set()
+        while frame is not None:
+            where = _where(frame)
+            if where not in seen:
+                seen.add(where)
+                self.total_counts[where] += 1
+            frame = frame.f_back
+
+    def top(self, n=30):
+        share = lambda count: round(count / max(self.samples, 1), 4)
+        return {
+            'samples': self.samples,
+            'interval_s': self.interval,
+            'self': [{'function': where, 'share': share(count)} for where, count in self.self_counts.most_common(n)],
+            'total': [{'function': where, 'share': share(count)} for where, count in self.total_counts.most_common(n)],
+        }
+
+
+def _where(frame):
+    code = frame.f_code
+    return '%s:%s:%d' % (os.path.basename(code.co_filename), code.co_name, code.co_firstlineno)
+
+
+class RunReport:
+    """Timers, row counts, peak memory and extra stats of one pipeline stage, saved as json
+
+    Hot sections are timed with the section() context manager, or with lap()
+    in module-level scripts, where every lap ends the one before. A sampler
+    thread reads the RSS every interval seconds to give each section its
+    peak, and with profile on it also samples the main thread's stack.
+    finish() writes {report_dir}/{stage}.json and appends it to
+    {report_dir}/history.jsonl, so runs can be compared.
+    """
+    def __init__(self, stage, report_dir='./reports', profile=False, interval=0.05, profile_interval=0.005):
+        self.stage = stage
+        self.report_dir = report_dir
+        self.started = datetime.now().isoformat(timespec='seconds')
+        self.start = time.perf_counter()
+        self.sections = {}
+        self.active = {}
+        self.counts = Counter()
+        self.extra = {}
+        self.lock = threading.Lock()
+        self.lap_name = None
+        self.peak = current_rss()
+        self.finished = False
+
+        self.profiler = SamplingProfiler(threading.main_thread().ident, profile_interval) if profile else None
+        self.interval = profile_interval if profile else interval
+        self.memory_every = max(1, int(round(interval / self.interval)))
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+        atexit.register(self.finish)
+
+    @classmethod
+    def from_config(cls, stage):
+        """Report of a stage set up from report_dir, profile (true or a list of stages) and profile_interval in the config"""
+        configs = load_config()
+        profile = configs.get('profile', False)
+        profile = stage in profile if isinstance(profile, list) else bool(profile)
+        return cls(stage, configs.get('report_dir', './reports'), profile, profile_interval=configs.get('profile_interval', 0.005))
+
+    def _sample(self):
+        tick = 0
+        while not self.stop_event.wait(self.interval):
+            if self.profiler is not None:
+                self.profiler.sample()
+            tick += 1
+            if tick % self.memory_every == 0:
+                self._memory()
+
+    def _memory(self):
+        rss = current_rss()
+        with self.lock:
+            self.peak = max(self.peak, rss)
+            for name in self.active:
+                self.sections[name]['peak_rss'] = max(self.sections[name]['peak_rss'], rss)
+
+    def _open(self, name):
+        with self.lock:
+            entry = self.sections.setdefault(name, {'calls': 0, 'seconds': 0., 'peak_rss': 0})
+            entry['calls'] += 1
+            self.active[name] = self.active.get(name, 0) + 1
+        self._memory()
+        return time.perf_counter()
+
+    def _close(self, name, start):
+        self._memory()
+        with self.lock:
+            self.sections[name]['seconds'] += time.perf_counter() - start
+            self.active[name] -= 1
+            if self.active[name] == 0:
+                del self.active[name]
+
+    @contextmanager
+    def section(self, name):
+        start = self._open(name)
+        try:
+            yield
+        finally:
+            self._close(name, start)
+
+    def lap(self, name=None):
+        """End the running lap and start the section name, None only ends it"""
+        if self.lap_name is not None:
+            self._close(*self.lap_name)
+            self.lap_name = None
+        if name is not None:
+            self.lap_name = (name, self._open(name))
+
+    def rows(self, name, n):
+        """Add to a row counter"""
+        with self.lock:
+            self.counts[name] += int(n)
+
+    def add(self, key, value):
+        """Extra json-serialisable stats, e.g. the fetcher's endpoint counts"""
+        self.extra[key] = value
+
+    def to_dict(self):
+        wall = time.perf_counter() - self.start
+        mb = lambda n: round(n / 1024 ** 2, 1)
+        report = {
+            'stage': self.stage,
+            'started': self.started,
+            'wall_s': round(wall, 3),
+            'peak_rss_mb': mb(self.peak),
+            'children_peak_rss_mb': mb(_peak_rss('children')),
+            'sections': {name: {'calls': entry['calls'], 'seconds': round(entry['seconds'], 3),
+                                'share': round(entry['seconds'] / wall, 4) if wall > 0 else None,
+                                'peak_rss_mb': mb(entry['peak_rss'])}
+                         for name, entry in self.sections.items()},
+            'rows': dict(self.counts),
+        }
+        report.update(self.extra)
+        if self.profiler is not None:
+            report['profile'] = self.profiler.top()
+        return report
+
+    def finish(self):
+        if self.finished:
+            return
+        self.lap()
+        self.stop_event.set()
+        self.thread.join()
+        self._memory()
+        self.finished = True
+        report = self.to_dict()
+        os.makedirs(self.report_dir, exist_ok=True)
+        path = os.path.join(self.report_dir, f'{self.stage}.json')
+        with open(path + '.tmp', 'w') as file:
+            json.dump(report, file, indent=1, default=str)
+        os.replace(path + '.tmp', path)
+        with open(os.path.join(self.report_dir, 'history.jsonl'), 'a') as file:
+            file.write(json.dumps(report, default=str) + '\n')
+        return report
@@ -0,0 +1,30 @@
+import os
+import json
+
+
+class State:
+    """Values by section and key kept in a json file, saved atomically"""
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, 'r') as file:
+                self.entries = json.load(file)
+
+    def get(self, section, key):
+        return self.entries.get(section, {}).get(key)
+
+    def set(self, section, key, value):
+        self.entries.setdefault(section, {})[key] = value
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(self.entries, file, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+class Manifest(State):
+    """Last trade_date / ann_date held for every endpoint and code of the raw data store"""
+    def set(self, endpoint, code, last):
+        super().set(endpoint, code, str(last))
@@ -0,0 +1,174 @@
+import numpy as np
+import pandas as pd
+from rolling import RollingReturns, shift_months
+from storage import Store
+from schema import to_date
+
+FIN_COLS = ['roe', 'roa', 'npta', 'assets_yoy', 'bps', 'debt_to_assets'] # npta 总资产净利润, assets_yoy 总资产同比增长率, bps 每股净资产
+
+
+def month_grid(years):
+    """First day of every month of the given years, as ints YYYYMM01"""
+    return [int(year) * 10000 + month * 100 + 1 for year in years for month in range(1, 13)]
+
+
+def complete_months(trade_cal, last_date, start_year=2000):
+    """month_grid from start_year to the last month whose trading days all lie on or before last_date"""
+    open_days = trade_cal.loc[trade_cal['is_open'] == 1, 'cal_date'].values.astype(np.int64)
+    month_end = pd.Series(open_days).groupby(open_days // 100).max()
+    done = month_end.index[month_end.values <= int(last_date)]
+    if len(done) == 0:
+        return []
+    last_month = int(done.max()) * 100 + 1
+    return [month for month in month_grid(range(start_year, last_month // 10000 + 1)) if month <= last_month]
+
+
+def month_start(dates):
+    return to_date(dates) // 100 * 100 + 1
+
+
+def _first_last(df, keys):
+    """Masks of the first and last row of every group of a frame sorted by keys"""
+    first = ~df.duplicated(subset=keys, keep='first').values
+    last = ~df.duplicated(subset=keys, keep='last').values
+    return first, last
+
+
+def resample_bars(df, months, code_col='ts_code', date_col='trade_date'):
+    """Monthly open, close and compounded return of every code from daily bars
+
+    Days without pct_chg are left out, open is the first open and close the
+    last close of the remaining days. Only months in the months grid are kept.
+    """
+    df = df.dropna(subset=['pct_chg'])
+    df = df.assign(date=month_start(df[date_col]))
+    df = df[df['date'].isin(months)].sort_values(by=[code_col, date_col], kind='stable')
+    first, last = _first_last(df, [code_col, 'date'])
+
+    log_ret = np.log(1 + df['pct_chg'].values.astype(np.float64) / 100)
+    group = np.cumsum(first) - 1
+    out = df.loc[first, [code_col, 'date']].rename(columns={code_col: 'code'}).reset_index(drop=True)
+    out['open'] = df['open'].values[first]
+    out['close'] = df['close'].values[last]
+    out['return'] = np.exp(np.bincount(group, weights=log_ret, minlength=len(out))) - 1
+    return out
+
+
+def resample_first(df, months, fields, code_col='ts_code', date_col='trade_date'):
+    """First row of every code and month"""
+    df = df.assign(date=month_start(df[date_col]))
+    df = df[df['date'].isin(months)].sort_values(by=[code_col, date_col], kind='stable')
+    first, _ = _first_last(df, [code_col, 'date'])
+    out = df.loc[first, [code_col, 'date'] + list(fields.keys())]
+    return out.rename(columns=dict(fields, **{code_col: 'code'})).reset_index(drop=True)
+
+
+def shibor_month(shibor_df, months, default=3.5):
+    """1y shibor of the first fixing of every month, default where the month has none"""
+    first = resample_first(shibor_df.assign(code='shibor'), months, {'1y': 'shibor'},
+                           code_col='code', date_col='date')
+    out = pd.DataFrame({'date': months})
+    out = out.merge(first[['date', 'shibor']], on='date', how='left', indicator=True)
+    out.loc[out['_merge'] == 'left_only', 'shibor'] = default
+    out['shibor'] = out['shibor'] / 100
+    return out[['date', 'shibor']]
+
+
+def market_month(index_df, months, months_back=6):
+    """Monthly return of the market index and its annualised return over the previous months_back months"""
+    bars = resample_bars(index_df, months)
+    market = pd.DataFrame({'code': index_df['ts_code'].iloc[0] if len(index_df) else '', 'date': months})
+    market = market.merge(bars[['date', 'return']], on='date', how='left')
+
+    # the window looks back from every month of the grid, not only months with data
+    rolling = RollingReturns(index_df)
+    market['market_return_ann'] = rolling.momentum(market['code'].values, market['date'].values, months_back)
+    market = market.rename(columns={'return': 'market_return_month'})
+    return market[['date', 'market_return_ann', 'market_return_month']]
+
+
+def fin_months(financial_df, codes, months, periods=('1231',), lag_months=None, max_age_months=18):
+    """Latest financial report known at the start of every month, for all stocks in one as-of merge
+
+    A report counts as known from the first month starting after its ann_date,
+    or after end_date + lag_months when a lag is given (also the fallback
+    without ann_date, with 4 months). periods picks the report periods used,
+    ('0630', '1231') adds the semiannual ones. Reports older than
+    max_age_months at the month start are not carried forward.
+    """
+    df = financial_df[financial_df['end_date'].astype(str).str[4:].isin(list(periods))]
+    df = df.sort_values(by=['ts_code', 'end_date', 'ann_date'], kind='stable')
+    df = df.drop_duplicates(subset=['ts_code', 'end_date'], keep='first')
+    df = df.rename(columns={'ts_code': 'code'})[['code', 'end_date', 'ann_date'] + FIN_COLS]
+    # as-of merges need the same key type on both sides, the grid's codes are plain strings
+    df['code'] = df['code'].astype(str)
+
+    end_date = pd.to_datetime(df['end_date'].astype(str), format='%Y%m%d')
+    lagged = end_date + pd.DateOffset(months=4 if lag_months is None else lag_months)
+    if lag_months is None:
+        known = pd.to_datetime(df['ann_date'].astype(str), format='%Y%m%d', errors='coerce').fillna(lagged)
+    else:
+        known = lagged
+    df = df.assign(known=known.values.astype('datetime64[ns]'), end_dt=end_date.values.astype('datetime64[ns]'))
+    # a report announced after a later period's is superseded from the start
+    df = df.sort_values(by=['code', 'known'], kind='stable')
+    df = df[df['end_dt'] >= df.groupby('code', observed=True)['end_dt'].cummax()]
+
+    grid = pd.DataFrame([(code, date) for code in codes for date in months], columns=['code', 'date'])
+    grid['month_dt'] = pd.to_datetime(grid['date'].astype(str), format='%Y%m%d').values.astype('datetime64[ns]')
+    fin_month_df = pd.merge_asof(grid.sort_values(by='month_dt', kind='stable'), df.sort_values(by='known', kind='stable'),
+                                 left_on='month_dt', right_on='known', by='code', allow_exact_matches=False)
+    fresh = fin_month_df['month_dt'] <= fin_month_df['end_dt'] + pd.DateOffset(months=max_age_months)
+    fin_month_df = fin_month_df[fin_month_df['known'].notna() & fresh]
+    return fin_month_df[['code', 'date'] + FIN_COLS].reset_index(drop=True)
+
+
+def stock_months(stock_df, basic_df, financial_df, codes, months, windows, fin_options):
+    """Monthly bar, daily_basic and financial rows of a set of stocks
+
+    windows maps 'vol' and 'momentum' to (lookback, skip) in months,
+    fin_options are passed on to fin_months.
+    """
+    stock_month_df = resample_bars(stock_df, months)
+    rolling = RollingReturns(stock_df)
+    month_codes, month_dates = stock_month_df['code'].values, stock_month_df['date'].values
+    stock_month_df['vol'] = rolling.vol(month_codes, month_dates, *windows['vol'])
+    stock_month_df['momentum'] = rolling.momentum(month_codes, month_dates, *windows['momentum'])
+
+    basic_month_df = resample_first(basic_df, months, {'total_share': 'total_share', 'total_mv': 't_mv', 'pb': 't_pb', 'pe_ttm': 't_pe'})
+    # only months the stock traded in
+    basic_month_df = basic_month_df.merge(stock_month_df[['code', 'date']], on=['code', 'date'], how='inner')
+
+    fin_month_df = fin_months(financial_df, codes, months, **fin_options)
+    return stock_month_df, basic_month_df, fin_month_df
+
+
+def process_codes(data_root, codes, months, windows, fin_options, start=None):
+    """stock_months of a chunk of stocks read straight from the store, what the worker processes run
+
+    With start, the first of the months, only the rows these months need are
+    read: daily rows back to the longest window and reports recent enough
+    to be carried into them.
+    """
+    store = Store(data_root)
+    bars_start = fin_start = None
+    if start is not None:
+        bars_start = int(shift_months([start], max(lookback for lookback, _ in windows.values()))[0])
+        fin_start = int(shift_months([start], fin_options.get('max_age_months', 18))[0])
+    return stock_months(store.read('daily', codes=codes, date_col='trade_date', start=bars_start),
+                        store.read('basic', codes=codes, date_col='trade_date', start=start),
+                        store.read('financial', codes=codes, date_col='end_date', start=fin_start),
+                        codes, months, windows, fin_options)
+
+
+def write_months(store, dataset, df, first, date_col=None):
+    """Write a monthly output, replacing it on a full run or adding the months from first on to it on an update"""
+    if first is None:
+        store.write(dataset, df, date_col=date_col)
+    elif date_col is None:
+        old = store.read(dataset)
+        store.write(dataset, pd.concat([old[old['date'] < first], df], axis=0, ignore_index=True))
+    else:
+        # only the year partitions of the new months are rewritten, in the row order of a full run
+        store.write(dataset, df, date_col=date_col, key=['code', date_col], sort_by=[date_col])
+
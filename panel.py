@@ -0,0 +1,90 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+
+class Panel:
+    """Numeric fields of a set of stocks over a set of dates, as one dense array
+
+    values has shape (fields, dates, codes) so every field is a contiguous
+    dates x codes block, mask marks the (date, code) cells that have a row.
+    Dates and codes map to integer positions through dicts, so a cross
+    section or a time series is an O(1) lookup and a view, not a filter.
+    """
+    def __init__(self, dates, codes, fields, values, mask):
+        self.dates = np.asarray(dates)
+        self.codes = np.asarray(codes)
+        self.fields = list(fields)
+        self.values = values
+        self.mask = mask
+        self.date_index = {date: i for i, date in enumerate(self.dates.tolist())}
+        self.code_index = {code: i for i, code in enumerate(self.codes.tolist())}
+        self.field_index = {field: i for i, field in enumerate(self.fields)}
+
+    @classmethod
+    def from_frame(cls, df, fields=None, date_col='date', code_col='code', dtype=np.float32):
+        """Panel of a long frame with one row per (date, code), codes keep their order of first appearance
+
+        Values are float32 like the stored frames, sums over them are taken in float64.
+        """
+        if fields is None:
+            fields = [col for col in df.columns if col not in (date_col, code_col) and pd.api.types.is_numeric_dtype(df[col])]
+        dates = np.sort(df[date_col].unique())
+        codes = np.asarray(df[code_col].unique()).astype(object)
+        t = np.searchsorted(dates, df[date_col].values)
+        n = pd.Index(codes).get_indexer(df[code_col].values)
+
+        values = np.full((len(fields), len(dates), len(codes)), np.nan, dtype=dtype)
+        for i, field in enumerate(fields):
+            values[i, t, n] = df[field].values
+        mask = np.zeros((len(dates), len(codes)), dtype=bool)
+        mask[t, n] = True
+        return cls(dates, codes, fields, values, mask)
+
+    @property
+    def shape(self):
+        return len(self.dates), len(self.codes), len(self.fields)
+
+    def field(self, name):
+        """dates x codes view of a field"""
+        return self.values[self.field_index[name]]
+
+    def cross_section(self, date, field=None):
+        """codes of one date, fields x codes, or a single field's row"""
+        t = self.date_index[date]
+        if field is None:
+            return self.values[:, t, :]
+        return self.values[self.field_index[field], t, :]
+
+    def series(self, code, field=None):
+        """dates of one code, fields x dates, or a single field's column"""
+        n = self.code_index[code]
+        if field is None:
+            return self.values[:, :, n]
+        return self.values[self.field_index[field], :, n]
+
+    def to_frame(self, date_col='date', code_col='code'):
+        """Long frame of the valid cells, date-major"""
+        t, n = np.nonzero(self.mask)
+        out = pd.DataFrame({date_col: self.dates[t], code_col: self.codes[n]})
+        for i, field in enumerate(self.fields):
+            out[field] = self.values[i, t, n]
+        return out
+
+    def save(self, path):
+        """Write to a directory of .npy arrays and a json index"""
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'values.npy'), self.values)
+        np.save(os.path.join(path, 'mask.npy'), self.mask)
+        with open(os.path.join(path, 'index.json'), 'w') as file:
+            json.dump({'dates': self.dates.tolist(), 'codes': self.codes.tolist(), 'fields': self.fields}, file)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Read a saved panel, memory-mapped unless mmap_mode is None"""
+        with open(os.path.join(path, 'index.json')) as file:
+            index = json.load(file)
+        values = np.load(os.path.join(path, 'values.npy'), mmap_mode=mmap_mode)
+        mask = np.load(os.path.join(path, 'mask.npy'), mmap_mode=mmap_mode)
+        return cls(index['dates'], index['codes'], index['fields'], values, mask)
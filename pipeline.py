@@ -0,0 +1,148 @@
+"""Run the pipeline stages as a DAG, re-running only what changed
+
+    python pipeline.py                  # every stage that is out of date
+    python pipeline.py factor --force   # stage 3 and what it needs, stage 3 always
+
+A stage's fingerprint hashes its code (the script and every local module
+it imports), the config keys it reads and the content of its input files.
+A stage runs when its fingerprint differs from the one of its last
+successful run or an output is missing, independent stages run in
+parallel. Fingerprints and file hashes are kept in pipeline_state.json of
+the work directory, files are only re-hashed when their size or mtime
+changed.
+"""
+import os
+import sys
+import time
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from manifest import State
+from fingerprints import fingerprint, code_fingerprint, FileHashes
+from config import load_config
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+state_path = './pipeline_state.json'
+
+RAW = ['data/universe.parquet', 'data/trade_cal.parquet', 'data/financial', 'data/daily', 'data/basic', 'data/membership.npz']
+
+STAGES = {
+    'fetch': {'script': '01_data_fetch.py', 'deps': [], 'inputs': [],
+              'params': ['fetch_mode', 'universe', 'update', 'offline', 'start_year', 'end_year'], 'outputs': ['data'],
+              # an update run fetches whatever is new upstream, there is nothing local to compare
+              'always': 'update'},
+    'process': {'script': '02_data_process.py', 'deps': ['fetch'], 'inputs': RAW + ['data/shibor', 'data/index', 'data/manifest.json'],
+                'params': ['update', 'start_year'], 'outputs': ['data_month/combined_all']},
+    'factor': {'script': '03_get_factor.py', 'deps': ['process'],
+               'inputs': ['data_month/market_month.parquet', 'data_month/combined_all', 'data_month/shibor_month.parquet',
+                          'data/universe.parquet'],
+               'params': ['update'], 'outputs': ['data_processed/stock_factors_processed', 'data_processed/factor_returns.parquet']},
+    'daily': {'script': '04_daily_factor.py', 'deps': ['fetch'], 'inputs': RAW,
+              'params': ['daily_chunk_days', 'daily_rebalance_days', 'daily_window_days'],
+              'outputs': ['data_daily/factor_daily', 'data_daily/exposure_daily']},
+    'backtest': {'script': 'backtest.py', 'deps': ['factor'],
+                 'inputs': ['data_processed/stock_factors_processed', 'data_processed/factor_returns.parquet'],
+                 'params': [], 'outputs': ['data_processed/momentum_sweep.parquet']},
+    'resampling': {'script': 'resampling.py', 'deps': ['factor', 'backtest'],
+                   'inputs': ['data_processed/factor_returns.parquet', 'data_processed/momentum_sweep.parquet', 'data_processed/stock_factors'],
+                   'params': [], 'outputs': ['data_processed/resampling.parquet']},
+    'portfolios': {'script': 'portfolios.py', 'deps': ['factor'], 'inputs': ['data_processed/stock_factors'],
+                   'params': [], 'outputs': ['data_processed/factor_variants.parquet']},
+}
+
+
+def stage_fingerprint(name, configs, hashes, root=ROOT):
+    spec = STAGES[name]
+    code = code_fingerprint(spec['script'], root)
+    params = {key: configs.get(key) for key in spec['params']}
+    inputs = [(path, hashes.path(path)) for path in spec['inputs']]
+    return fingerprint(name, code, params, inputs)
+
+
+def with_deps(targets):
+    """Targets and every stage they depend on"""
+    out, todo = set(), list(targets)
+    while todo:
+        name = todo.pop()
+        if name not in out:
+            out.add(name)
+            todo += STAGES[name]['deps']
+    return out
+
+
+def run_stage(name, launcher, log_dir):
+    command = [sys.executable] + ([os.path.join(ROOT, launcher)] if launcher else []) + [os.path.join(ROOT, STAGES[name]['script'])]
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, os.environ.get('PYTHONPATH', '')]))
+    with open(os.path.join(log_dir, f'{name}.log'), 'w') as log:
+        return subprocess.call(command, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def run(targets=None, force=(), workers=2, dry_run=False, launcher=None, log_dir='./logs'):
+    """Run the out-of-date stages of targets and their dependencies, returns {stage: 'ran' | 'skipped' | 'failed'}"""
+    configs = load_config()
+    os.makedirs(log_dir, exist_ok=True)
+    state = State(state_path)
+    hashes = FileHashes(state)
+
+    todo = with_deps(targets or list(STAGES))
+    status = {}
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while todo or running:
+            # a stage is ready once its dependencies are done, its inputs are final then
+            for name in sorted(todo):
+                deps = [status.get(dep) for dep in STAGES[name]['deps']]
+                if any(dep is None for dep in deps):
+                    continue
+                todo.discard(name)
+                if 'failed' in deps:
+                    status[name] = 'failed'
+                    continue
+                current = stage_fingerprint(name, configs, hashes)
+                always = STAGES[name].get('always') and configs.get(STAGES[name]['always'])
+                missing = any(not os.path.exists(path) for path in STAGES[name]['outputs'])
+                if name not in force and not always and not missing and state.get('stages', name) == current:
+                    status[name] = 'skipped'
+                    print(f'{name}: up to date')
+                elif dry_run:
+                    status[name] = 'skipped'
+                    print(f'{name}: would run')
+                else:
+                    print(f'{name}: running')
+                    running[pool.submit(run_stage, name, launcher, log_dir)] = (name, current, time.perf_counter())
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, current, start = running.pop(future)
+                if future.result() == 0:
+                    status[name] = 'ran'
+                    state.set('stages', name, current)
+                    print(f'{name}: done in {time.perf_counter() - start:.1f}s')
+                else:
+                    status[name] = 'failed'
+                    print(f'{name}: failed, see {os.path.join(log_dir, name + ".log")}')
+                state.save()
+    state.save()
+    return status
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('targets', nargs='*', help='stages to bring up to date, all by default: ' + ', '.join(STAGES))
+    parser.add_argument('--force', nargs='*', default=None, help='stages to run even when up to date, the targets without names')
+    parser.add_argument('--workers', type=int, default=2, help='stages run at the same time')
+    parser.add_argument('--dry-run', action='store_true')
+    parser.add_argument('--fake', action='store_true', help='run the stages against fake_tushare, see FAKE_TUSHARE')
+    args = parser.parse_args()
+    unknown = [name for name in args.targets + (args.force or []) if name not in STAGES]
+    if unknown:
+        parser.error('unknown stages: ' + ', '.join(unknown))
+
+    force = set(args.targets or STAGES) if args.force == [] else set(args.force or [])
+    status = run(args.targets, force, args.workers, args.dry_run, 'fake_tushare.py' if args.fake else None)
+    sys.exit(1 if 'failed' in status.values() else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+"""Sorted portfolios and long-short factors as sparse weight matrices
+
+    python portfolios.py --schemes equal value capped
+
+Portfolios are formed at every rebalance from single sorts or 2x3
+size/characteristic double sorts (independent or conditional on size)
+and held until the next one. Their weights over all months live in one
+sparse dates x (portfolio, code) matrix: column p * n_codes + n is code n
+in portfolio p, and every month is renormalised over the members with a
+return, so a portfolio earns like the equal-weighted leg means of
+factor_engine. Returns of every portfolio come from one product of the
+matrix with the panel's returns, factors are linear combinations of
+portfolios and their turnover is the sum of absolute weight changes.
+"""
+import argparse
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from storage import Store
+from panel import Panel
+from factor_engine import DEFAULT_FACTORS, formation_dates
+from instrument import RunReport
+
+# size splits at the median, characteristics at the 30th and 70th percentiles, as Fama-French's 2x3 sorts
+SIZE_BREAKPOINTS = (0.5,)
+CHAR_BREAKPOINTS = (0.3, 0.7)
+
+
+def buckets(x, valid, breakpoints, ascending=True):
+    """Bucket of every stock of one cross section by rank, 0 the first in sort order, -1 where invalid
+
+    breakpoints are fractions of the ranked stocks, the first bucket holds
+    int(n * breakpoints[0]) stocks and the last int(n * (1 - breakpoints[-1])),
+    as rank_legs' legs. Ties keep position order.
+    """
+    out = np.full(len(x), -1, dtype=np.int64)
+    idx = np.flatnonzero(valid & ~np.isnan(x))
+    order = idx[np.argsort(x[idx] if ascending else -x[idx], kind='stable')]
+    n = len(order)
+    edges = [int(n * bp) for bp in breakpoints[:-1]] + [n - int(n * (1 - breakpoints[-1]))]
+    out[order] = np.searchsorted(np.asarray(edges), np.arange(n), side='right')
+    return out
+
+
+def sort_labels(panel, rebalance, sorts, conditional=False):
+    """Portfolio of every code at every rebalance date, rebalance x codes, -1 outside all portfolios
+
+    sorts is a list of (field, breakpoints, ascending), the portfolio of a
+    double sort is first bucket * buckets of the second + second bucket.
+    Only stocks with all fields are sorted. conditional sorts on the
+    second field within each bucket of the first, else on the whole cross
+    section.
+    """
+    labels = np.full((len(rebalance), len(panel.codes)), -1, dtype=np.int64)
+    for i, date in enumerate(rebalance):
+        if date not in panel.date_index:
+            continue
+        t = panel.date_index[date]
+        valid = panel.mask[t].copy()
+        for field, _, _ in sorts:
+            valid &= ~np.isnan(panel.field(field)[t])
+        label = np.zeros(len(panel.codes), dtype=np.int64)
+        for j, (field, breakpoints, ascending) in enumerate(sorts):
+            x = panel.field(field)[t]
+            if conditional and j > 0:
+                bucket = np.full(len(x), -1, dtype=np.int64)
+                for group in np.unique(label[valid]):
+                    within = valid & (label == group)
+                    bucket[within] = buckets(x, within, breakpoints, ascending)[within]
+            else:
+                bucket = buckets(x, valid, breakpoints, ascending)
+            label = label * (len(breakpoints) + 1) + bucket
+        labels[i] = np.where(valid, label, -1)
+    return labels
+
+
+class Weights:
+    """Weights of a set of portfolios over the dates of a panel, as a sparse dates x (portfolio, code) matrix"""
+    def __init__(self, dates, codes, names, matrix):
+        self.dates = np.asarray(dates)
+        self.codes = np.asarray(codes)
+        self.names = list(names)
+        self.matrix = sparse.csr_matrix(matrix)
+
+    @classmethod
+    def from_labels(cls, panel, rebalance, labels, names, scheme='equal', size_field='size', cap=0.8, ret_field='return'):
+        """Weights of the portfolios of sort_labels over the months they are held
+
+        scheme is equal, value (size at the rebalance) or capped (size capped
+        at its cap quantile among the stocks held from the rebalance). Every
+        month's weights are renormalised over the members with a return.
+        """
+        formed = np.searchsorted(rebalance, panel.dates, side='right') - 1
+        held = np.flatnonzero(formed >= 0)
+        base = np.ones(labels.shape)
+        if scheme in ('value', 'capped'):
+            rows = [panel.date_index.get(date) for date in rebalance]
+            size = np.stack([panel.field(size_field)[t] if t is not None else np.full(len(panel.codes), np.nan) for t in rows])
+            size = np.where(labels >= 0, size, np.nan)
+            if scheme == 'capped':
+                sorted_ = ~np.isnan(size).all(axis=1)
+                size[sorted_] = np.minimum(size[sorted_], np.nanquantile(size[sorted_], cap, axis=1, keepdims=True))
+            base = np.where(np.isnan(size) | (size <= 0), 0., size)
+        elif scheme != 'equal':
+            raise ValueError(f'unknown weighting {scheme}')
+
+        n_codes, n_port = len(panel.codes), len(names)
+        label = labels[formed[held]]
+        has_ret = panel.mask[held] & ~np.isnan(panel.field(ret_field)[held])
+        t, n = np.nonzero((label >= 0) & has_ret)
+        p = label[t, n]
+        data = base[formed[held][t], n]
+        keep = data > 0
+        t, n, p, data = t[keep], n[keep], p[keep], data[keep]
+        total = np.bincount(t * n_port + p, weights=data, minlength=len(held) * n_port)
+        data = data / total[t * n_port + p]
+        matrix = sparse.csr_matrix((data, (t, p * n_codes + n)), shape=(len(held), n_port * n_codes))
+        return cls(panel.dates[held], panel.codes, names, matrix)
+
+    def _block_sum(self, coefficients=None):
+        """(portfolio, code) x portfolio matrix summing each portfolio's block, or combining blocks with coefficients"""
+        n_codes = len(self.codes)
+        coefficients = np.eye(len(self.names)) if coefficients is None else coefficients
+        return sparse.kron(sparse.csr_matrix(coefficients), sparse.csr_matrix(np.ones((n_codes, 1)))).tocsr()
+
+    def returns(self, ret):
+        """dates x portfolios returns of the dates x codes returns of the same dates, NaN where a portfolio holds nothing"""
+        w = self.matrix.tocoo()
+        r = np.nan_to_num(np.asarray(ret, dtype=np.float64))[w.row, w.col % len(self.codes)]
+        earned = (sparse.csr_matrix((w.data * r, (w.row, w.col)), shape=w.shape) @ self._block_sum()).toarray()
+        held = (self.matrix @ self._block_sum()).toarray()
+        return np.where(held > 0, earned, np.nan)
+
+    def turnover(self):
+        """dates x portfolios sum of absolute weight changes from the month before, the first month from nothing"""
+        change = self.matrix - sparse.vstack([sparse.csr_matrix((1, self.matrix.shape[1])), self.matrix[:-1]])
+        return (abs(change) @ self._block_sum()).toarray()
+
+    def combine(self, factors):
+        """Weights of linear combinations of the portfolios, factors maps a name to {portfolio: coefficient}"""
+        coefficients = self.coefficients(factors)
+        n_codes = len(self.codes)
+        blocks = sparse.kron(sparse.csr_matrix(coefficients), sparse.identity(n_codes)).tocsr()
+        return Weights(self.dates, self.codes, list(factors), self.matrix @ blocks)
+
+    def coefficients(self, factors):
+        """portfolios x factors matrix of the combinations"""
+        out = np.zeros((len(self.names), len(factors)))
+        for j, legs in enumerate(factors.values()):
+            for name, coefficient in legs.items():
+                out[self.names.index(name), j] = coefficient
+        return out
+
+    @classmethod
+    def stack(cls, weights, prefixes):
+        """One set of the portfolios of several weights on the same dates and codes, names prefixed"""
+        names = [f'{prefix}{name}' for prefix, w in zip(prefixes, weights) for name in w.names]
+        return cls(weights[0].dates, weights[0].codes, names, sparse.hstack([w.matrix for w in weights]))
+
+
+def single_sort(panel, rebalance, factors=DEFAULT_FACTORS, scheme='equal', **options):
+    """Long and short legs of every factor sorted on its own column, the first and last ratio of the ranked stocks
+
+    Returns the weights of the legs, named {factor}_long and {factor}_short,
+    and the factors as {factor: {leg: coefficient}}.
+    """
+    weights, combos = [], {}
+    for name, factor in factors.items():
+        sort = [(factor['col'], (factor['ratio'], 1 - factor['ratio']), factor['ascending'])]
+        labels = sort_labels(panel, rebalance, sort)
+        # the middle bucket is not held
+        labels[labels == 1] = -1
+        labels[labels == 2] = 1
+        weights.append(Weights.from_labels(panel, rebalance, labels, ['long', 'short'], scheme, **options))
+        combos[name] = {f'{name}_long': 1., f'{name}_short': -1.}
+    return Weights.stack(weights, [f'{name}_' for name in factors]), combos
+
+
+def double_sort(panel, rebalance, factors=DEFAULT_FACTORS, scheme='equal', conditional=False, size='SMB', **options):
+    """Fama-French 2x3 portfolios of size and every other factor's column, and the factors made of them
+
+    A characteristic factor is the mean of its long corner over the two
+    size halves minus the mean of its short corner, the size factor the
+    mean of the small minus the big portfolios over all the sorts.
+    Portfolios are named {factor}_{size bucket}{characteristic bucket}.
+    """
+    size_factor = factors[size]
+    weights, combos = [], {size: {}}
+    chars = [name for name in factors if name != size]
+    for name in chars:
+        factor = factors[name]
+        sorts = [(size_factor['col'], SIZE_BREAKPOINTS, size_factor['ascending']),
+                 (factor['col'], CHAR_BREAKPOINTS, factor['ascending'])]
+        labels = sort_labels(panel, rebalance, sorts, conditional)
+        names = ['%d%d' % (s, c) for s in range(2) for c in range(3)]
+        weights.append(Weights.from_labels(panel, rebalance, labels, names, scheme, **options))
+        combos[name] = {f'{name}_{s}{c}': sign / 2 for s in range(2) for c, sign in [(0, 1.), (2, -1.)]}
+        for s, sign in [(0, 1.), (1, -1.)]:
+            for c in range(3):
+                combos[size][f'{name}_{s}{c}'] = sign / (3 * len(chars))
+    return Weights.stack(weights, [f'{name}_' for name in chars]), {name: combos[name] for name in factors}
+
+
+def factor_table(panel, weights, combos, ret_field='return'):
+    """Long frame of the monthly return and turnover of every factor from its portfolios' weights"""
+    ret = weights.returns(panel.field(ret_field)[np.searchsorted(panel.dates, weights.dates)])
+    coefficients = weights.coefficients(combos)
+    # NaN where a portfolio the factor uses holds nothing, not where any does
+    factor_ret = np.nan_to_num(ret) @ coefficients
+    factor_ret[np.isnan(ret).astype(np.float64) @ (coefficients != 0) > 0] = np.nan
+    turnover = weights.combine(combos).turnover()
+    return pd.DataFrame({'date': np.repeat(weights.dates, len(combos)), 'factor': np.tile(list(combos), len(weights.dates)),
+                         'return': factor_ret.ravel(), 'turnover': turnover.ravel()})
+
+
+def variants(panel, rebalance, factors=DEFAULT_FACTORS, schemes=('equal', 'value', 'capped'), cap=0.8):
+    """factor_table of every weighting scheme and sort, with scheme and sort columns"""
+    frames = []
+    for scheme in schemes:
+        for sort, build in [('single', lambda: single_sort(panel, rebalance, factors, scheme, cap=cap)),
+                            ('2x3', lambda: double_sort(panel, rebalance, factors, scheme, cap=cap)),
+                            ('2x3_conditional', lambda: double_sort(panel, rebalance, factors, scheme, conditional=True, cap=cap))]:
+            weights, combos = build()
+            frames.append(factor_table(panel, weights, combos).assign(scheme=scheme, sort=sort))
+    return pd.concat(frames, ignore_index=True)[['date', 'scheme', 'sort', 'factor', 'return', 'turnover']]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--schemes', nargs='+', default=['equal', 'value', 'capped'], choices=['equal', 'value', 'capped'])
+    parser.add_argument('--cap', type=float, default=0.8, help='quantile of size the capped weights stop at')
+    parser.add_argument('--data', default='data_processed')
+    args = parser.parse_args()
+    report = RunReport.from_config('portfolios')
+
+    report.lap('read')
+    store = Store(args.data)
+    stocks = store.read('stock_factors')
+    panel = Panel.from_frame(stocks, fields=['return', 'size', 'value', 'profitability', 'investment', 'momentum'])
+    # the same April rebalances as 03_get_factor.py
+    rebalance = formation_dates(panel.dates, months=(4,), start=20010401)
+
+    report.lap('portfolios')
+    table = variants(panel, rebalance, DEFAULT_FACTORS, args.schemes, args.cap)
+    report.lap('write')
+    store.write('factor_variants', table)
+    report.rows('factor_variants', len(table))
+    summary = table.groupby(['scheme', 'sort', 'factor'], sort=False).agg(mean=('return', 'mean'), turnover=('turnover', 'mean'))
+    print(summary.unstack('factor').to_string(float_format='%.4f'))
+    report.finish()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+"""Query layer over the Parquet stores, for notebooks and downstream scripts
+
+    from query import load
+    df = load('daily', codes=['000001.SZ'], fields=['close', 'pct_chg'], start=20200101, end=20201231)
+
+Only the year partitions that overlap [start, end] and the requested
+columns (plus the code and date columns) are read. Columns are decoded
+once per file and kept in an LRU cache bounded by a memory budget, so
+the next slice of the same data is a filter over cached arrays and does
+not touch the files. A file that changes on disk is read again.
+"""
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from schema import CODE_COLS, enforce
+from config import load_config
+
+ROOTS = ['./data', './data_month', './data_processed', './data_daily']
+# the column a dataset is partitioned and filtered on, the first one it has
+DATE_KEYS = ['date', 'trade_date', 'end_date', 'cal_date']
+
+
+class ColumnCache:
+    """Decoded columns keyed by file, file version and column, least recently used evicted past budget bytes"""
+    def __init__(self, budget):
+        self.budget = budget
+        self.columns = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.columns:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.columns.move_to_end(key)
+            return self.columns[key][0]
+
+    def put(self, key, values):
+        size = int(values.memory_usage(index=False, deep=True))
+        if size > self.budget:
+            return
+        with self.lock:
+            if key in self.columns:
+                self.bytes -= self.columns.pop(key)[1]
+            self.columns[key] = (values, size)
+            self.bytes += size
+            while self.bytes > self.budget:
+                self.bytes -= self.columns.popitem(last=False)[1][1]
+
+    def info(self):
+        with self.lock:
+            return {'columns': len(self.columns), 'mb': round(self.bytes / 1024 ** 2, 1),
+                    'budget_mb': round(self.budget / 1024 ** 2, 1), 'hits': self.hits, 'misses': self.misses}
+
+
+class Catalog:
+    """The datasets of a list of store roots, read through one column cache"""
+    def __init__(self, roots=ROOTS, budget_mb=512):
+        self.roots = list(roots)
+        self.cache = ColumnCache(budget_mb * 1024 ** 2)
+
+    def path(self, dataset):
+        for root in self.roots:
+            for path in [os.path.join(root, f'{dataset}.parquet'), os.path.join(root, dataset)]:
+                if os.path.exists(path):
+                    return path
+        raise KeyError(f'{dataset} is in none of {", ".join(self.roots)}')
+
+    def files(self, dataset, start=None, end=None):
+        """Parquet files of a dataset, only the year partitions that overlap [start, end]"""
+        path = self.path(dataset)
+        if os.path.isfile(path):
+            return [path]
+        out = []
+        for part in sorted(os.listdir(path)):
+            if not part.startswith('year='):
+                continue
+            year = int(part[len('year='):])
+            if (start is not None and year < int(start) // 10000) or (end is not None and year > int(end) // 10000):
+                continue
+            part_dir = os.path.join(path, part)
+            out += [os.path.join(part_dir, name) for name in sorted(os.listdir(part_dir)) if name.endswith('.parquet')]
+        return out
+
+    def fields(self, dataset):
+        """Column names of a dataset, from the file footer"""
+        files = self.files(dataset)
+        return pq.read_schema(files[0]).names if files else []
+
+    def _columns(self, path, columns):
+        """Columns of one file, decoded and typed, from the cache where possible"""
+        stat = os.stat(path)
+        version = (path, stat.st_mtime_ns, stat.st_size)
+        out = {col: self.cache.get(version + (col,)) for col in columns}
+        missing = [col for col, values in out.items() if values is None]
+        if missing:
+            df = enforce(pq.read_table(path, columns=missing, memory_map=True).to_pandas())
+            for col in missing:
+                out[col] = df[col]
+                self.cache.put(version + (col,), df[col])
+        return out
+
+    def load(self, dataset, codes=None, fields=None, start=None, end=None):
+        """Rows of a dataset for codes and dates in [start, end], with the code and date columns and fields
+
+        Every argument left as None does not filter, dates are YYYYMMDD ints or strings.
+        """
+        names = self.fields(dataset)
+        code_col = next((col for col in CODE_COLS if col in names), None)
+        date_col = next((col for col in DATE_KEYS if col in names), None)
+        if (codes is not None and code_col is None) or ((start, end) != (None, None) and date_col is None):
+            raise ValueError(f'{dataset} has no code or date column to filter on')
+        keys = [col for col in [code_col, date_col] if col is not None]
+        columns = keys + [col for col in (fields if fields is not None else names) if col not in keys and col != 'year']
+
+        frames = []
+        for path in self.files(dataset, start, end):
+            # the filter columns first, a file without matching rows is not decoded further
+            values = self._columns(path, keys or columns[:1])
+            mask = np.ones(len(next(iter(values.values()))), dtype=bool)
+            if codes is not None:
+                mask &= values[code_col].isin(list(codes)).values
+            if start is not None:
+                mask &= values[date_col].values >= int(start)
+            if end is not None:
+                mask &= values[date_col].values <= int(end)
+            rows = np.flatnonzero(mask)
+            if len(rows) == 0:
+                continue
+            values.update(self._columns(path, [col for col in columns if col not in values]))
+            frames.append(pd.DataFrame({col: values[col].take(rows).reset_index(drop=True) for col in columns}))
+        if not frames:
+            files = self.files(dataset)
+            if not files:
+                return pd.DataFrame(columns=columns)
+            # typed like a match: the empty table of the file schema through the same schema enforcement
+            return enforce(pq.read_schema(files[0]).empty_table().select(columns).to_pandas())
+        return enforce(pd.concat(frames, axis=0, ignore_index=True))
+
+
+_catalog = None
+
+
+def catalog():
+    """The catalog over the default stores, with the query_cache_mb of the config as budget"""
+    global _catalog
+    if _catalog is None:
+        configs = load_config()
+        _catalog = Catalog(ROOTS, configs.get('query_cache_mb', 512))
+    return _catalog
+
+
+def load(dataset, codes=None, fields=None, start=None, end=None):
+    """Catalog.load on the default stores"""
+    return catalog().load(dataset, codes, fields, start, end)
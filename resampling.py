@@ -0,0 +1,214 @@
+"""Stationary block bootstrap and random-portfolio permutation tests of the factor premia and strategies
+
+    python resampling.py --reps 10000 --block 6 --permutations 1000
+
+Bootstrap: every replication draws the months of the return and factor
+tables together, in blocks that start at a random month and end after
+each month with probability 1 / block (Politis-Romano), so the serial
+correlation within a block survives. The mean, Sharpe and alpha of every
+series are recomputed on each draw, giving percentile confidence
+intervals and p-values of the recentred distribution.
+
+Permutation: the legs of every factor are redrawn at random among the
+stocks the sort ranked, with the sort's leg sizes, and held like the real
+ones. The share of random portfolios with a premium at least as large as
+the factor's is its p-value.
+
+Replications run in chunks, each with its own seed spawned from --seed
+and spread over a process pool, so memory is bounded by a chunk and the
+results do not depend on the number of workers.
+"""
+import os
+import argparse
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from storage import Store
+from panel import Panel
+from analytics import FACTOR_COLS
+from factor_engine import DEFAULT_FACTORS, formation_dates, factor_returns
+from instrument import RunReport
+
+
+def stationary_indices(rng, n, size, block):
+    """size x n month indices of stationary bootstrap samples with mean block length block, wrapping around"""
+    start = rng.integers(0, n, size=(size, n))
+    new = rng.random((size, n)) < 1. / block
+    new[:, 0] = True
+    pos = np.arange(n)
+    first = np.maximum.accumulate(np.where(new, pos, 0), axis=1)
+    return (np.take_along_axis(start, first, axis=1) + pos - first) % n
+
+
+def series_stats(y, x=None, periods=12):
+    """Mean, annualised Sharpe and alpha of every replication and series
+
+    y is replications x months x series, x replications x months x
+    (constant + factors) or None. Months where a series or a factor is
+    missing are left out of that series' statistics.
+    """
+    used = ~np.isnan(y)
+    n = used.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(used, y, 0.).sum(axis=1) / n
+        sd = np.sqrt((np.where(used, y - mean[:, None, :], 0.) ** 2).sum(axis=1) / (n - 1))
+        out = {'mean': mean, 'sharpe': mean / sd * np.sqrt(periods)}
+    if x is not None:
+        used = used & ~np.isnan(x).any(axis=2)[:, :, None]
+        x = np.nan_to_num(x)
+        xtx = np.einsum('btp,bts,btq->bspq', x, used.astype(np.float64), x)
+        xty = np.einsum('btp,bts->bsp', x, np.where(used, y, 0.))
+        # pinv: a draw can repeat too few months for the normal equations to be regular
+        out['alpha'] = (np.linalg.pinv(xtx) @ xty[..., None])[..., 0, 0]
+    return out
+
+
+def _bootstrap_chunk(y, x, block, periods, seed, size):
+    idx = stationary_indices(np.random.default_rng(seed), y.shape[0], size, block)
+    return series_stats(y[idx], None if x is None else x[idx], periods)
+
+
+def _map_chunks(func, reps, chunk, seed, workers):
+    """func(seed, size) over chunks of the replications, with seeds spawned from seed, results concatenated"""
+    sizes = [min(chunk, reps - i) for i in range(0, reps, chunk)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    if workers > 1 and len(sizes) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(sizes))) as executor:
+            results = list(executor.map(func, seeds, sizes))
+    else:
+        results = [func(s, size) for s, size in zip(seeds, sizes)]
+    return {key: np.concatenate([result[key] for result in results]) for key in results[0]}
+
+
+def _table(names, estimate, draws, p_value, method, level):
+    rows = []
+    for stat in estimate:
+        low, high = np.nanquantile(draws[stat], [(1 - level) / 2, (1 + level) / 2], axis=0)
+        for i, name in enumerate(names):
+            rows.append({'series': name, 'stat': stat, 'method': method, 'estimate': estimate[stat][i],
+                         'ci_low': low[i], 'ci_high': high[i], 'p_value': p_value[stat][i], 'reps': len(draws[stat])})
+    return pd.DataFrame(rows)
+
+
+def bootstrap(returns, factors=None, reps=10000, block=6, seed=0, chunk=500, workers=1, periods=12, level=0.95):
+    """Stationary block bootstrap of the mean, Sharpe and alpha of every column of a returns frame
+
+    factors is a months x factors frame on the same months, for the alphas.
+    ci_low and ci_high are percentile intervals at level, p_value the
+    two-sided share of recentred draws at least as far from 0 as the estimate.
+    """
+    y = returns.values.astype(np.float64)
+    x = None if factors is None else np.column_stack([np.ones(len(factors)), np.asarray(factors, dtype=np.float64)])
+    estimate = {key: values[0] for key, values in series_stats(y[None], None if x is None else x[None], periods).items()}
+    draws = _map_chunks(partial(_bootstrap_chunk, y, x, block, periods), reps, chunk, seed, workers)
+    p_value = {stat: (1 + (np.abs(draws[stat] - estimate[stat]) >= np.abs(estimate[stat])).sum(axis=0)) / (1. + reps)
+               for stat in estimate}
+    return _table(list(returns.columns), estimate, draws, p_value, 'bootstrap', level)
+
+
+def _permutation_chunk(ret, valid, periods_legs, n_factors, periods, seed, size):
+    """Means and Sharpes of the long-short returns of size sets of random legs, size x factors"""
+    rng = np.random.default_rng(seed)
+    series = np.full((size, n_factors, ret.shape[0]), np.nan)
+    draws = np.arange(size)[:, None]
+    for rows, candidates in periods_legs:
+        r, v = ret[rows], valid[rows].astype(np.float64)
+        for i, (codes, k) in enumerate(candidates):
+            if k == 0:
+                continue
+            order = codes[np.argsort(rng.random((size, len(codes))), axis=1)]
+            legs = []
+            for leg in [order[:, :k], order[:, -k:]]:
+                member = np.zeros((size, ret.shape[1]))
+                member[draws, leg] = 1.
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    legs.append((r @ member.T) / (v @ member.T))
+            series[:, i, rows] = (legs[0] - legs[1]).T
+    stats = series_stats(series.transpose(0, 2, 1), None, periods)
+    return {'mean': stats['mean'], 'sharpe': stats['sharpe']}
+
+
+def permutation_test(panel, factors=DEFAULT_FACTORS, months=(4,), start=None, reps=1000, seed=0, chunk=200, workers=1,
+                     periods=12, level=0.95, ret_field='return'):
+    """Random-portfolio test of every factor's mean and Sharpe against legs drawn at random
+
+    Each rebalance draws legs of the sort's sizes among the stocks it
+    ranked, and they earn like the factor's, as equal-weighted means of the
+    members with a return in the month. ci_low and ci_high are the range of
+    the random portfolios at level.
+    """
+    rebalance = formation_dates(panel.dates, months, start)
+    formed = np.searchsorted(rebalance, panel.dates, side='right') - 1
+    held = formed >= 0
+    ret = panel.field(ret_field)[held].astype(np.float64)
+    valid = panel.mask[held] & ~np.isnan(ret)
+    ret = np.where(valid, ret, 0.)
+
+    # per rebalance: the months it is held and, per factor, the stocks ranked and the leg size
+    periods_legs = []
+    for j, date in enumerate(rebalance):
+        rows = np.flatnonzero(formed[held] == j)
+        if len(rows) == 0 or date not in panel.date_index:
+            continue
+        t = panel.date_index[date]
+        candidates = []
+        for factor in factors.values():
+            codes = np.flatnonzero(panel.mask[t] & ~np.isnan(panel.field(factor['col'])[t]))
+            candidates.append((codes, int(len(codes) * factor['ratio'])))
+        periods_legs.append((rows, candidates))
+
+    observed = factor_returns(panel, factors, months, start, ret_field)
+    estimate = series_stats(observed[list(factors)].values[None], None, periods)
+    estimate = {'mean': estimate['mean'][0], 'sharpe': estimate['sharpe'][0]}
+    draws = _map_chunks(partial(_permutation_chunk, ret, valid, periods_legs, len(factors), periods), reps, chunk, seed, workers)
+    p_value = {stat: (1 + (np.abs(draws[stat]) >= np.abs(estimate[stat])).sum(axis=0)) / (1. + reps) for stat in estimate}
+    return _table(list(factors), estimate, draws, p_value, 'permutation', level)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--reps', type=int, default=10000, help='bootstrap replications')
+    parser.add_argument('--block', type=float, default=6, help='mean block length in months')
+    parser.add_argument('--permutations', type=int, default=1000, help='random-portfolio replications, 0 skips them')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--chunk', type=int, default=500, help='replications per task, this bounds the memory')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--level', type=float, default=0.95)
+    parser.add_argument('--data', default='data_processed')
+    args = parser.parse_args()
+    report = RunReport.from_config('resampling')
+    store = Store(args.data)
+    options = dict(seed=args.seed, chunk=args.chunk, workers=args.workers, level=args.level)
+
+    report.lap('factors')
+    # the long-short factors, alphas against the market
+    factor_table = store.read('factor_returns').sort_values(by='date')
+    premia = list(DEFAULT_FACTORS)
+    tables = [bootstrap(factor_table[premia], factor_table[['market']], args.reps, args.block, **options)]
+
+    if store.exists('momentum_sweep'):
+        report.lap('strategies')
+        # the momentum strategies of backtest.py, alphas against the factor table
+        sweep = store.read('momentum_sweep')
+        returns = sweep.pivot_table(index='date', columns=['formation', 'holding', 'cost'], values='net')
+        returns.columns = ['J%d_K%d_c%g' % col for col in returns.columns]
+        factors = factor_table.set_index('date').reindex(returns.index)[FACTOR_COLS]
+        tables.append(bootstrap(returns, factors, args.reps, args.block, **options))
+
+    if args.permutations > 0:
+        report.lap('permutations')
+        stocks = store.read('stock_factors')
+        panel = Panel.from_frame(stocks, fields=['return', 'size', 'value', 'profitability', 'investment', 'momentum'])
+        tables.append(permutation_test(panel, DEFAULT_FACTORS, months=(4,), start=20010401, reps=args.permutations, **options))
+
+    report.lap('write')
+    table = pd.concat(tables, ignore_index=True)
+    store.write('resampling', table)
+    report.rows('resampling', len(table))
+    print(table.to_string(index=False, float_format='%.4f'))
+    report.finish()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+
+
+def shift_months(dates, months):
+    """Move YYYYMMDD dates by a number of months, as ints YYYYMMDD"""
+    dates = np.asarray(dates).astype(np.int64)
+    index = (dates // 10000) * 12 + (dates // 100) % 100 - 1 - months
+    return (index // 12) * 10000 + (index % 12 + 1) * 100 + dates % 100
+
+
+class RollingReturns:
+    """Trailing-window statistics of daily returns for every code at once
+
+    Daily returns are sorted by code and date once and turned into prefix sums
+    of the day count, returns, squared returns and log returns. The sums over
+    any window are then a difference of two prefix sums, found with one
+    searchsorted over all queries, so every lookback costs O(queries) on top
+    of the single O(rows) pass.
+    """
+    def __init__(self, df, code_col='ts_code', date_col='trade_date', ret_col='pct_chg', scale=100.):
+        df = df.sort_values(by=[code_col, date_col], kind='stable')
+        self.codes = {code: i for i, code in enumerate(df[code_col].unique())}
+        code_idx = pd.Index(list(self.codes)).get_indexer(df[code_col]).astype(np.int64)
+        self.keys = code_idx * 10 ** 8 + df[date_col].astype(np.int64).values
+
+        rets = df[ret_col].values.astype(np.float64) / scale
+        valid = ~np.isnan(rets)
+        rets = np.where(valid, rets, 0.)
+        self.count = np.r_[0, np.cumsum(valid)]
+        self.sum = np.r_[0., np.cumsum(rets)]
+        self.sumsq = np.r_[0., np.cumsum(rets ** 2)]
+        self.sumlog = np.r_[0., np.cumsum(np.log(1 + rets))]
+
+    def window(self, codes, dates, lookback=6, skip=0):
+        """Day count and sums of returns, squared returns and log returns over
+        [date - lookback months, date - skip months) for every (code, date) pair"""
+        code_idx = np.array([self.codes.get(code, -1) for code in codes], dtype=np.int64)
+        start = code_idx * 10 ** 8 + shift_months(dates, lookback)
+        end = code_idx * 10 ** 8 + shift_months(dates, skip)
+        lo = np.searchsorted(self.keys, start, side='left')
+        hi = np.searchsorted(self.keys, end, side='left')
+        hi[code_idx < 0] = lo[code_idx < 0]
+        n = self.count[hi] - self.count[lo]
+        return n, self.sum[hi] - self.sum[lo], self.sumsq[hi] - self.sumsq[lo], self.sumlog[hi] - self.sumlog[lo]
+
+    def vol(self, codes, dates, lookback=6, skip=0, days=220):
+        """Standard deviation of daily returns divided by the number of days and scaled by days"""
+        n, s, sq, _ = self.window(codes, dates, lookback, skip)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            var = np.maximum(sq - s * s / n, 0) / (n - 1)
+            return np.where(n > 1, np.sqrt(var) / n * days, np.nan)
+
+    def momentum(self, codes, dates, lookback=6, skip=0, days=220):
+        """Mean daily log return annualised with days"""
+        n, _, _, sl = self.window(codes, dates, lookback, skip)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(n > 0, np.exp(sl / n * days) - 1, np.nan)
@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+
+# dates are int32 YYYYMMDD, 0 where there is none, so filters and sorts compare integers
+DATE_COLS = ['date', 'trade_date', 'cal_date', 'end_date', 'ann_date', 'f_ann_date', 'list_date', 'delist_date', 'pretrade_date']
+# codes are categoricals with sorted categories, names only live in the code -> name table 'universe'
+CODE_COLS = ['code', 'ts_code', 'con_code', 'index_code']
+# monthly returns, rates and factor returns are compounded and regressed, they stay float64, other floats are float32
+FLOAT64_COLS = ['return', 'market', 'rf', 'shibor', 'market_return_month', 'market_return_ann',
+                'SMB', 'HML', 'RMW', 'CMA', 'UMD', 'gross', 'turnover', 'net',
+                # the shibor fixings of every tenor
+                'on', '1w', '2w', '1m', '3m', '6m', '9m', '1y']
+
+
+def to_date(values):
+    """int32 YYYYMMDD of 'YYYYMMDD' strings, numbers or datetimes, 0 where missing"""
+    values = pd.Series(values) if not isinstance(values, pd.Series) else values
+    if values.dtype == np.int32:
+        return values
+    if pd.api.types.is_datetime64_any_dtype(values):
+        values = values.dt.year * 10000 + values.dt.month * 100 + values.dt.day
+    else:
+        values = pd.to_numeric(values.astype(object) if isinstance(values.dtype, pd.CategoricalDtype) else values, errors='coerce')
+    return values.fillna(0).astype(np.int32)
+
+
+def to_code(values):
+    """Categorical codes, categories sorted so sorting by code sorts as the strings do"""
+    values = pd.Series(values) if not isinstance(values, pd.Series) else values
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        values = values.cat.remove_unused_categories()
+        if values.cat.categories.is_monotonic_increasing:
+            return values
+        return values.cat.reorder_categories(values.cat.categories.sort_values())
+    return values.astype('category')
+
+
+def enforce(df):
+    """df with the schema's types, columns the schema does not know keep theirs"""
+    changes = {}
+    for col in df.columns:
+        if col in DATE_COLS:
+            changes[col] = to_date(df[col])
+        elif col in CODE_COLS:
+            changes[col] = to_code(df[col])
+        elif pd.api.types.is_float_dtype(df[col]):
+            dtype = np.float64 if col in FLOAT64_COLS else np.float32
+            if df[col].dtype != dtype:
+                changes[col] = df[col].astype(dtype)
+    return df.assign(**changes) if changes else df
+
+
+def date_array(values):
+    """int64 numpy array of dates, e.g. to searchsorted them"""
+    return to_date(values).to_numpy().astype(np.int64)
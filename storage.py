@@ -0,0 +1,152 @@
+import os
+import shutil
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from schema import DATE_COLS, CODE_COLS, enforce
+
+
+class Store:
+    """Parquet store replacing the per-stock csv files
+
+    Datasets with a date column live in {root}/{dataset}/year=YYYY/part.parquet,
+    each partition sorted by code and date, plus part-{date}.parquet files
+    of appended chunks. Tables without one are a single
+    {root}/{dataset}.parquet. Frames are written and read in the types of
+    schema.py: int32 dates, categorical codes (plain strings in the files,
+    which parquet dictionary-encodes) and float32 values.
+    """
+    def __init__(self, root, compression='zstd'):
+        self.root = root
+        self.compression = compression
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+    def path(self, dataset):
+        table_path = os.path.join(self.root, f'{dataset}.parquet')
+        if os.path.exists(table_path):
+            return table_path
+        return os.path.join(self.root, dataset)
+
+    def exists(self, dataset):
+        return os.path.exists(self.path(dataset))
+
+    def _write_file(self, df, path):
+        tmp_path = path + '.tmp'
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        for i, field in enumerate(table.schema):
+            if pa.types.is_dictionary(field.type):
+                table = table.set_column(i, field.name, table.column(i).cast(field.type.value_type))
+        pq.write_table(table, tmp_path, compression=self.compression)
+        os.replace(tmp_path, path)
+
+    def write(self, dataset, df, date_col=None, key=None, sort_by=None, keep='last'):
+        """Write a dataset
+
+        Without a key the dataset is replaced. With a key, rows are merged into
+        the existing year partitions, sorted by sort_by (default key) and
+        deduplicated on key keeping the first or last row. Every partition is
+        swapped in atomically.
+        """
+        df = _normalize(df)
+        if date_col is None:
+            dir_path = os.path.join(self.root, dataset)
+            if os.path.isdir(dir_path):
+                shutil.rmtree(dir_path)
+            self._write_file(df, os.path.join(self.root, f'{dataset}.parquet'))
+            return
+
+        dir_path = os.path.join(self.root, dataset)
+        if key is None and os.path.isdir(dir_path):
+            shutil.rmtree(dir_path)
+        sort_by = sort_by or key or [date_col]
+
+        for year, df_year in df.groupby(df[date_col] // 10000, sort=True):
+            part_dir = os.path.join(dir_path, f'year={year}')
+            part_path = os.path.join(part_dir, 'part.parquet')
+            if not os.path.exists(part_dir):
+                os.makedirs(part_dir)
+            parts = [name for name in os.listdir(part_dir) if name.endswith('.parquet')]
+            if key is not None and parts:
+                df_old = enforce(pq.read_table(part_dir, partitioning=None, memory_map=True).to_pandas())
+                df_year = pd.concat([df_old, df_year], axis=0, ignore_index=True)
+            df_year = df_year.sort_values(by=sort_by, ascending=True, kind='stable')
+            if key is not None:
+                df_year = df_year.drop_duplicates(subset=key, keep=keep)
+            self._write_file(_normalize(df_year), part_path)
+            # appended parts are now merged into part.parquet
+            for name in parts:
+                if name != 'part.parquet':
+                    os.remove(os.path.join(part_dir, name))
+
+    def append(self, dataset, df, date_col):
+        """Add rows to a partitioned dataset as new files, without reading or rewriting what is there
+
+        For output written in date order a chunk at a time, so memory is bounded
+        by the chunk. Rows are not deduplicated; the next write with a key
+        merges the parts of a partition back into one file.
+        """
+        df = _normalize(df)
+        for year, df_year in df.groupby(df[date_col] // 10000, sort=True):
+            part_dir = os.path.join(self.root, dataset, f'year={year}')
+            if not os.path.exists(part_dir):
+                os.makedirs(part_dir)
+            first = df_year[date_col].min()
+            self._write_file(df_year, os.path.join(part_dir, f'part-{first}.parquet'))
+
+    def remove(self, dataset):
+        path = self.path(dataset)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def read(self, dataset, columns=None, codes=None, code_col='ts_code', date_col=None, start=None, end=None):
+        """Read a dataset, column, code and date filters are pushed down to the files"""
+        path = self.path(dataset)
+        if not os.path.exists(path):
+            return pd.DataFrame(columns=columns)
+        if os.path.isfile(path):
+            df = enforce(pq.read_table(path, columns=columns, memory_map=True).to_pandas())
+            return _filter(df, codes, code_col, date_col, start, end)
+
+        filters = []
+        if codes is not None:
+            filters.append((code_col, 'in', list(codes)))
+        if start is not None:
+            filters += [('year', '>=', int(start) // 10000), (date_col, '>=', int(start))]
+        if end is not None:
+            filters += [('year', '<=', int(end) // 10000), (date_col, '<=', int(end))]
+        table = pq.read_table(path, columns=columns, filters=filters or None,
+                              partitioning='hive', memory_map=True)
+        if 'year' in table.column_names and (columns is None or 'year' not in columns):
+            table = table.drop(['year'])
+        return enforce(table.to_pandas())
+
+    def last_dates(self, dataset, code_col, date_col):
+        """Latest date held for every code"""
+        df = self.read(dataset, columns=[code_col, date_col])
+        if df.empty:
+            return {}
+        return df[df[date_col] > 0].groupby(code_col, observed=True)[date_col].max().to_dict()
+
+
+def _normalize(df):
+    # keep one schema across partitions: all-null columns and integers other than dates become floats
+    df = df.copy()
+    for col in df.columns:
+        if col in DATE_COLS or col in CODE_COLS:
+            continue
+        if df[col].isna().all() or pd.api.types.is_integer_dtype(df[col]):
+            df[col] = df[col].astype('float64')
+    return enforce(df)
+
+
+def _filter(df, codes, code_col, date_col, start, end):
+    if codes is not None:
+        df = df[df[code_col].isin(list(codes))]
+    if start is not None:
+        df = df[df[date_col] >= int(start)]
+    if end is not None:
+        df = df[df[date_col] <= int(end)]
+    return df
@@ -1,26 +1,169 @@
 import tushare as ts
 import pandas as pd
-from datetime import datetime, timedelta
+import time
+import random
+import threading
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from api_cache import ApiCache
+
+
+class TokenBucket:
+    """Token bucket shared by all worker threads of a fetcher"""
+    def __init__(self, rate_per_min, capacity=5):
+        self.rate = rate_per_min / 60.
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available, return the seconds spent waiting"""
+        waited = 0.
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+
+# tushare reports every failure as a plain Exception, so errors are told apart by message
+RATE_LIMIT_MSGS = ['每分钟最多访问', '每小时最多访问', '频率超限']
+FATAL_MSGS = ['没有访问该接口的权限', '您的token不对', '请指定正确的接口名']
+
+
+def is_rate_limited(error):
+    return any(msg in str(error) for msg in RATE_LIMIT_MSGS)
+
+
+def is_fatal(error):
+    return any(msg in str(error) for msg in FATAL_MSGS)
+
 
 class TushareFetcher:
-    def __init__(self, token):
+    def __init__(self, token, limit_per_min=200, workers=None, max_retries=5, backoff=1., cache_dir=None, cache_bytes=2 * 1024 ** 3, offline=False):
         self.pro = ts.pro_api(token)
         self.limit = 6000
-        self.limit_per_min = 200
+        self.limit_per_min = limit_per_min
 
         self.index_list = ['000001.SH', '000300.SH', '399300.SZ']
-        
-    def get_stock_basic(self):
-        """Get basic information of all stocks"""
-        return self.pro.stock_basic(
+        self.fina_fields = 'ts_code,ann_date,end_date,eps,current_ratio,quick_ratio,roe,roa,npta,assets_yoy,bps,debt_to_assets'
+
+        # a round-trip takes roughly 0.3s, so a handful of threads saturates the quota
+        self.workers = workers or max(1, self.limit_per_min // 25)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.rate_limit_wait = 15.
+        self.bucket = TokenBucket(self.limit_per_min)
+
+        # calls, rows, retries and throttled seconds per endpoint, for the run report
+        self.stats_lock = threading.Lock()
+        self.endpoint_stats = {}
+        self.call_times = {}
+
+        # offline only serves from the cache and never touches the network
+        self.cache = None
+        if cache_dir is not None or offline:
+            self.cache = ApiCache(cache_dir or './cache', max_bytes=cache_bytes, offline=offline)
+
+    def _count(self, api_name, **counts):
+        with self.stats_lock:
+            stats = self.endpoint_stats.setdefault(api_name, dict.fromkeys(
+                ['calls', 'cache_hits', 'rows', 'retries', 'rate_limited', 'capped', 'throttled_s', 'backoff_s'], 0))
+            for key, value in counts.items():
+                stats[key] += value
+
+    def _request(self, api_name, **kwargs):
+        """Call a pro_api endpoint under the rate limit, retrying on failure"""
+        if self.cache is not None:
+            df = self.cache.get(api_name, kwargs)
+            if df is not None:
+                self._count(api_name, cache_hits=1, rows=len(df))
+                return df
+            df = self._request_remote(api_name, **kwargs)
+            self.cache.put(api_name, kwargs, df)
+            return df
+        return self._request_remote(api_name, **kwargs)
+
+    def _request_remote(self, api_name, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            waited = self.bucket.acquire()
+            with self.stats_lock:
+                self.call_times.setdefault(api_name, []).append(time.monotonic())
+            self._count(api_name, calls=1, throttled_s=waited)
+            try:
+                df = getattr(self.pro, api_name)(**kwargs)
+                # an unpaged response as long as the row cap was probably cut short, full pages are expected
+                capped = 'offset' not in kwargs and len(df) >= (kwargs.get('limit') or self.limit)
+                self._count(api_name, rows=len(df), capped=int(capped))
+                return df
+            except Exception as e:
+                if attempt == self.max_retries or is_fatal(e):
+                    raise
+                delay = self.backoff * 2 ** attempt
+                if is_rate_limited(e):
+                    delay = max(delay, self.rate_limit_wait)
+                delay += random.uniform(0, self.backoff)
+                self._count(api_name, retries=1, rate_limited=int(is_rate_limited(e)), backoff_s=delay)
+                time.sleep(delay)
+
+    def stats(self):
+        """Per-endpoint counts with the busiest minute next to limit_per_min"""
+        with self.stats_lock:
+            out = {}
+            for api_name, stats in self.endpoint_stats.items():
+                times = sorted(self.call_times.get(api_name, []))
+                # most calls inside any 60s window
+                busiest = max([bisect_right(times, t + 60.) - i for i, t in enumerate(times)], default=0)
+                out[api_name] = dict(stats, throttled_s=round(stats['throttled_s'], 3), backoff_s=round(stats['backoff_s'], 3),
+                                     busiest_minute=busiest)
+            return {'limit': self.limit, 'limit_per_min': self.limit_per_min, 'workers': self.workers, 'endpoints': out}
+
+    def _request_paged(self, api_name, page_size=None, **kwargs):
+        """Call an endpoint page by page, the server caps every response at page_size rows"""
+        page_size = page_size or self.limit
+        pages = []
+        offset = 0
+        while True:
+            page = self._request(api_name, limit=page_size, offset=offset, **kwargs)
+            pages.append(page)
+            if len(page) < page_size:
+                break
+            offset += page_size
+        return pd.concat(pages, ignore_index=True)
+
+    def fetch_many(self, jobs):
+        """Run fetch jobs on the worker pool
+
+        jobs maps a key to (method name, kwargs), e.g.
+        {('000001.SZ', 'daily'): ('get_daily_data', {'ts_code': '000001.SZ', ...})}.
+        Yields (key, result) in completion order.
+        """
+        pool = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            futures = {pool.submit(getattr(self, name), **kwargs): key for key, (name, kwargs) in jobs.items()}
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def get_stock_basic(self, list_status='L'):
+        """Get basic information of all stocks, L listed, D delisted, P paused"""
+        return self._request('stock_basic',
             exchange='',
-            list_status='L',
-            fields='ts_code,symbol,name,area,industry,list_date'
+            list_status=list_status,
+            fields='ts_code,symbol,name,area,industry,list_date,list_status,delist_date'
         )
     
     def get_trade_calendar(self, start_date, end_date):
         """Get trading calendar"""
-        return self.pro.trade_cal(
+        return self._request('trade_cal',
             start_date=start_date,
             end_date=end_date,
             is_open='1',
@@ -29,7 +172,7 @@ class TushareFetcher:
     
     def get_daily_data(self, ts_code, start_date, end_date):
         """Get daily trading data for a specific stock"""
-        return self.pro.daily(
+        return self._request_paged('daily',
             ts_code=ts_code,
             start_date=start_date,
             end_date=end_date,
@@ -37,15 +180,15 @@ class TushareFetcher:
         )
     
     def get_daily_data_one(self, trade_date):
-        """Get daily trading data for a specific stock"""
-        return self.pro.daily(
+        """Get daily trading data of all stocks on one trading day"""
+        return self._request_paged('daily',
             trade_date=trade_date,
             fields='ts_code,trade_date,open,high,low,close,pct_chg,vol,amount'
         )
     
     def get_daily_basic(self, ts_code, start_date, end_date):
         """Get daily basic data for a specific stock"""
-        return self.pro.daily_basic(
+        return self._request_paged('daily_basic',
             ts_code=ts_code,
             start_date=start_date,
             end_date=end_date,
@@ -53,15 +196,15 @@ class TushareFetcher:
         )
 
     def get_daily_basic_one(self, trade_date):
-        """Get daily basic data for a specific stock"""
-        return self.pro.daily_basic(
+        """Get daily basic data of all stocks on one trading day"""
+        return self._request_paged('daily_basic',
             trade_date=trade_date,
             fields='ts_code,trade_date,turnover_rate,volume_ratio,pe,pe_ttm,pb,dv_ratio,dv_ttm,total_share,float_share,total_mv,circ_mv'
         )
     
     def get_index_data_one(self, ts_code, trade_date):
         """Get daily trading data for a specific stock"""
-        return self.pro.index_daily(
+        return self._request_paged('index_daily',
             ts_code=ts_code,
             trade_date=trade_date,
             fields='ts_code,trade_date,open,high,low,close,pct_chg,vol,amount'
@@ -69,14 +212,14 @@ class TushareFetcher:
     
     def get_index_basic_one(self, trade_date):
         """Get daily basic data for a specific stock"""
-        return self.pro.index_dailybasic(
+        return self._request('index_dailybasic',
             trade_date=trade_date,
             fields='ts_code,trade_date,turnover_rate,pe,pe_ttm,pb,total_share,float_share,total_mv'
         )
     
     def get_index_basic(self, ts_code, start_date, end_date):
         """Get basic information of all indices"""
-        return self.pro.index_dailybasic(
+        return self._request('index_dailybasic',
             ts_code=ts_code,
             start_date=start_date,
             end_date=end_date,
@@ -85,7 +228,7 @@ class TushareFetcher:
     
     def get_index_data(self, ts_code, start_date, end_date):
         """Get daily trading data for a specific stock"""
-        return self.pro.index_daily(
+        return self._request_paged('index_daily',
             ts_code=ts_code,
             start_date=start_date,
             end_date=end_date,
@@ -93,28 +236,54 @@ class TushareFetcher:
         )
     
     def get_fina_indicator(self, ts_code, start_date, end_date):
-        """Get financial indicators for a specific stock"""
-        return self.pro.fina_indicator(
+        """Get financial indicators for a specific stock announced between start_date and end_date"""
+        # fina_indicator returns at most 100 rows per request
+        return self._request_paged('fina_indicator',
+            page_size=100,
             ts_code=ts_code,
             start_date=start_date,
             end_date=end_date,
-            # fields='ts_code,end_date,eps,current_ratio,quick_ratio,roe'
+            fields=self.fina_fields,
         )
     
     def get_fina_indicator_one(self, ts_code, period):
         """Get financial indicators for a specific stock"""
-        return self.pro.fina_indicator(
+        return self._request('fina_indicator',
             ts_code=ts_code,
             period=period,
         )
     
+    def get_shibor(self, start_date, end_date):
+        """Get shibor rates"""
+        # shibor returns at most 2000 rows per request
+        return self._request_paged('shibor',
+            page_size=2000,
+            start_date=start_date,
+            end_date=end_date,
+        )
+
+    def get_index_weight(self, index_code, trade_date):
+        """Get index constituents and weights"""
+        return self._request('index_weight',
+            index_code=index_code,
+            trade_date=trade_date,
+        )
+
+    def get_index_weights(self, index_code, start_date, end_date):
+        """Get the monthly constituent snapshots of an index over a date range"""
+        return self._request_paged('index_weight',
+            index_code=index_code,
+            start_date=start_date,
+            end_date=end_date,
+        )
+
     def get_index_daily(self, ts_code, start_date, end_date):
         """Get daily index data"""
 
-        return self.pro.index_dailybasic(
+        return self._request('index_dailybasic',
             trade_date='20250327',
             )
-        return self.pro.index_daily(
+        return self._request_paged('index_daily',
             ts_code=ts_code,
             start_date=start_date,
             end_date=end_date,
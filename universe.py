@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+from schema import date_array
+
+
+class Universe:
+    """Point-in-time membership as a snapshot date x code bitmap
+
+    Every snapshot is one row of bits packed eight codes to a byte, so the
+    whole history of a 5000-name market at month ends is a few hundred KB.
+    A date is covered by the latest snapshot on or before it, membership of
+    many (code, date) pairs is one searchsorted and a bit test, not a join.
+    """
+    def __init__(self, dates, codes, bits):
+        self.dates = date_array(dates)
+        self.codes = np.asarray(codes).astype(str)
+        self.bits = bits
+        self.code_index = pd.Index(self.codes)
+
+    @classmethod
+    def from_members(cls, dates, codes, members):
+        """From a dates x codes bool matrix"""
+        return cls(dates, codes, np.packbits(members, axis=1))
+
+    @classmethod
+    def from_snapshots(cls, df, date_col='trade_date', code_col='con_code'):
+        """From index constituent snapshots, e.g. index_weight rows of one or several indices"""
+        row_dates = date_array(df[date_col])
+        row_codes = df[code_col].to_numpy().astype(str)
+        dates, codes = np.unique(row_dates), np.unique(row_codes)
+        members = np.zeros((len(dates), len(codes)), dtype=bool)
+        members[np.searchsorted(dates, row_dates), np.searchsorted(codes, row_codes)] = True
+        return cls.from_members(dates, codes, members)
+
+    @classmethod
+    def from_listings(cls, stock_basic, dates):
+        """The whole market at every date: listed on or before it and not delisted by then"""
+        dates = np.sort(date_array(dates))
+        stock_basic = stock_basic.drop_duplicates(subset='ts_code').sort_values(by='ts_code')
+        listed = date_array(stock_basic['list_date'])
+        delisted = date_array(stock_basic['delist_date']) if 'delist_date' in stock_basic else np.zeros(len(stock_basic), dtype=np.int64)
+        delisted[delisted == 0] = 99999999
+        members = (listed[None, :] <= dates[:, None]) & (dates[:, None] < delisted[None, :])
+        return cls.from_members(dates, stock_basic['ts_code'].to_numpy().astype(str), members)
+
+    def _rows(self, dates):
+        return np.searchsorted(self.dates, date_array(dates), side='right') - 1
+
+    def members(self, date):
+        """Codes in the universe as of date"""
+        row = self._rows([date])[0]
+        if row < 0:
+            return self.codes[:0]
+        bits = np.unpackbits(self.bits[row], count=len(self.codes)).astype(bool)
+        return self.codes[bits]
+
+    def contains(self, codes, dates):
+        """Membership of every (code, date) pair as of its date"""
+        col = self.code_index.get_indexer(np.asarray(codes).astype(str))
+        row = self._rows(dates)
+        known = (col >= 0) & (row >= 0)
+        col, row = np.maximum(col, 0), np.maximum(row, 0)
+        bit = (self.bits[row, col >> 3] >> (7 - (col & 7))) & 1
+        return known & (bit == 1)
+
+    def mask(self, dates, codes):
+        """dates x codes membership matrix, e.g. to mask a panel"""
+        dates, codes = np.asarray(dates), np.asarray(codes)
+        return self.contains(np.tile(codes, len(dates)), np.repeat(dates, len(codes))).reshape(len(dates), len(codes))
+
+    def all_codes(self):
+        """Codes that are members at some snapshot"""
+        ever = np.bitwise_or.reduce(self.bits, axis=0) if len(self.bits) else np.zeros(0, dtype=np.uint8)
+        return self.codes[np.unpackbits(ever, count=len(self.codes)).astype(bool)]
+
+    def save(self, path):
+        np.savez_compressed(path, dates=self.dates, codes=self.codes, bits=self.bits)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['dates'], data['codes'], data['bits'])